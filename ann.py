@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import math
+import numpy as np
+
+from utils import segment_sum
+
+
+# Scales every row to unit L2 norm, all-zero rows stay zero
+def _normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+# The nearest centroid of every vector, in blocks so the similarity matrix stays small
+def _assign(vectors, centroids, block_size = 65536):
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        assignments[start: start + block_size] = np.argmax(vectors[start: start + block_size] @ centroids.T, axis=1)
+    return assignments
+
+
+# Spherical k-means, the centroids are the normalized means of their vectors and empty lists are reseeded
+def _kmeans(vectors, n_lists, iterations, rng):
+    import torch
+
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _assign(vectors, centroids)
+        sums = segment_sum(torch.from_numpy(vectors), torch.from_numpy(assignments), n_lists).numpy()
+        empty = np.bincount(assignments, minlength=n_lists) == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = _normalize(sums).astype(np.float32)
+    return centroids
+
+
+class IVFIndex():
+    """
+    Inverted file index over the embeddings of a DocumentEmbeddingIndex for approximate cosine search. The vectors are
+    clustered with spherical k-means and stored grouped by nearest centroid, and a query only scans the vectors of
+    its n_probe nearest lists, so its cost grows with the square root of the collection instead of linearly. At the
+    'doc' level every document is its mean-pooled embedding, at the 'passage' level every chunk is indexed and a
+    document scores as its best chunk.
+    """
+
+    def __init__(self, folder_path, n_probe = 8):
+        self.folder_path = folder_path
+        self.centroids_file_path = os.path.join(folder_path, 'centroids.npy')
+        self.vectors_file_path = os.path.join(folder_path, 'vectors.f32')
+        self.row_docs_file_path = os.path.join(folder_path, 'row_docs.npy')
+        self.index_file_path = os.path.join(folder_path, 'index.json')
+        self.n_probe = n_probe
+        self.level = 'doc'
+        self.uids = []
+        self.offsets = None
+        self.centroids = None
+        self.vectors = None
+        self.row_docs = None
+
+    def __len__(self):
+        return len(self.uids)
+
+    def build(self, embedding_index, level = 'doc', n_lists = None, iterations = 10, train_size = None, seed = 0,
+              block_size = 4096):
+        """
+        Clusters the embeddings of every document of the embedding index and writes the inverted lists
+        :param embedding_index: a loaded DocumentEmbeddingIndex
+        :param level: 'doc' to index the mean-pooled document embeddings, 'passage' to index every chunk embedding
+        :param n_lists: the number of inverted lists, 4 * sqrt(vectors) by default
+        :param iterations: the number of k-means iterations
+        :param train_size: the number of vectors k-means is trained on, 256 per list by default
+        :param seed: the seed of the training sample and the initial centroids
+        :param block_size: the number of documents read from the embedding index at a time
+        :return: None
+        """
+
+        if level not in ('doc', 'passage'):
+            raise Exception("Unknown ANN index level %s" % level)
+
+        self.level = level
+        self.uids = sorted(embedding_index.doc_ranges)
+        os.makedirs(self.folder_path, exist_ok=True)
+
+        # The normalized vectors in document order, written to disk first so the collection never sits in memory
+        unordered_file_path = self.vectors_file_path + '.tmp'
+        row_docs = []
+        with open(unordered_file_path, 'wb') as file_handle:
+            for start in range(0, len(self.uids), block_size):
+                block = self.uids[start: start + block_size]
+                if level == 'doc':
+                    vectors = embedding_index.get_doc_embeddings(block)
+                    row_docs.append(np.arange(start, start + len(block)))
+                else:
+                    chunks = [embedding_index.get_chunk_embeddings(cord_uid) for cord_uid in block]
+                    vectors = np.concatenate(chunks)
+                    row_docs += [np.full(len(chunk_embeds), start + i) for i, chunk_embeds in enumerate(chunks)]
+                file_handle.write(_normalize(vectors).astype(np.float32).tobytes())
+        row_docs = np.concatenate(row_docs) if row_docs else np.zeros(0, dtype=np.int64)
+        vectors = np.memmap(unordered_file_path, dtype=np.float32, mode='r', shape=(len(row_docs), embedding_index.dim))
+
+        rng = np.random.RandomState(seed)
+        n_lists = min(n_lists or max(1, int(4 * math.sqrt(len(vectors)))), len(vectors))
+        train_size = min(train_size or 256 * n_lists, len(vectors))
+        # k-means draws its initial centroids from the training sample, so there cannot be more lists than samples
+        n_lists = min(n_lists, train_size)
+        self.centroids = _kmeans(np.asarray(vectors[np.sort(rng.choice(len(vectors), train_size, replace=False))]),
+                                 n_lists, iterations, rng)
+
+        # Every list is a contiguous range of rows, so probing it is a single slice
+        assignments = _assign(vectors, self.centroids)
+        order = np.argsort(assignments, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+        with open(self.vectors_file_path, 'wb') as file_handle:
+            for start in range(0, len(order), block_size):
+                file_handle.write(np.asarray(vectors[order[start: start + block_size]]).tobytes())
+        del vectors
+        os.remove(unordered_file_path)
+
+        np.save(self.centroids_file_path, self.centroids)
+        np.save(self.row_docs_file_path, row_docs[order])
+        with open(self.index_file_path, 'w') as file_handle:
+            json.dump({'level': level, 'dim': embedding_index.dim, 'rows': len(order), 'offsets': self.offsets.tolist(),
+                       'uids': self.uids}, file_handle)
+        self.load()
+
+    def load(self):
+        """
+        Loads the centroids and the list offsets and memory-maps the vectors
+        :return: None
+        """
+
+        with open(self.index_file_path) as file_handle:
+            index = json.load(file_handle)
+
+        self.level = index['level']
+        self.uids = index['uids']
+        self.offsets = np.array(index['offsets'], dtype=np.int64)
+        self.centroids = np.load(self.centroids_file_path)
+        self.row_docs = np.load(self.row_docs_file_path)
+        self.vectors = None
+        if index['rows']:
+            self.vectors = np.memmap(self.vectors_file_path, dtype=np.float32, mode='r',
+                                     shape=(index['rows'], index['dim']))
+
+    def search(self, query_embeds, n, n_probe = None):
+        """
+        Approximate top-n documents of every query by cosine similarity
+        :param query_embeds: a (queries x dim) array
+        :param n: the number of documents to return per query
+        :param n_probe: the number of lists scanned per query, the index default if None
+        :return: for every query a list of (cord_uid, score), best first
+        """
+
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        query_embeds = _normalize(np.asarray(query_embeds, dtype=np.float32))
+        probed_lists = np.argsort(-(query_embeds @ self.centroids.T), axis=1, kind='stable')[:, :n_probe]
+
+        results = []
+        for query_embed, probed in zip(query_embeds, probed_lists):
+            ranges = [(self.offsets[list_id], self.offsets[list_id + 1]) for list_id in np.sort(probed)]
+            scores = np.concatenate([self.vectors[start: end] @ query_embed for start, end in ranges])
+            docs = np.concatenate([self.row_docs[start: end] for start, end in ranges])
+
+            # A document scores as its best row, the first one in descending score order
+            order = np.argsort(-scores, kind='stable')
+            _, first = np.unique(docs[order], return_index=True)
+            best = order[np.sort(first)][:n]
+            results.append([(self.uids[docs[i]], float(scores[i])) for i in best])
+        return results
+
+
+def recall_at_k(approx, exact):
+    """
+    Computes the share of the exact top-k documents of every topic that the approximate ranking also returns
+    :param approx: the ranked (qid, docid, score, rank) tuples of the approximate run
+    :param exact: the ranked (qid, docid, score, rank) tuples of the exhaustive run
+    :return: a dict with the mean recall and the recall of every topic
+    """
+
+    approx_docs, exact_docs = {}, {}
+    for qid, docid, _, _ in approx:
+        approx_docs.setdefault(qid, set()).add(docid)
+    for qid, docid, _, _ in exact:
+        exact_docs.setdefault(qid, set()).add(docid)
+
+    per_topic = {qid: len(docs & approx_docs.get(qid, set())) / len(docs) for qid, docs in exact_docs.items()}
+    return {'recall': sum(per_topic.values()) / max(len(per_topic), 1), 'per_topic': per_topic}
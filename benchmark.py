@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Throughput benchmark of the ranking pipeline on synthetic CORD-19 fixtures and a tiny randomly initialized BERT,
+# so it runs offline without the dataset or a pretrained model. Example:
+#   python benchmark.py --docs 2000 --topics 10 --output bench.json
+
+import os
+import csv
+import json
+import time
+import random
+import string
+import argparse
+import resource
+import tempfile
+
+import numpy as np
+
+from data import TopicCollection
+from data_loader import TrecCovidDatasetManager
+from utils import split_doc, TopKAccumulator
+
+METADATA_COLUMNS = ['cord_uid', 'sha', 'source_x', 'title', 'doi', 'pmcid', 'pubmed_id', 'license', 'abstract',
+                    'publish_time', 'authors', 'journal', 'mag_id', 'who_covidence_id', 'arxiv_id', 'pdf_json_files',
+                    'pmc_json_files', 'url', 's2_id']
+
+
+def make_vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9))))
+    return sorted(words)
+
+
+def generate_fixtures(folder_path, n_docs, n_topics, vocabulary, rng, paragraphs = (2, 20), paragraph_words = (20, 200)):
+    """
+    Writes a synthetic round3-like collection: metadata.csv, document_parses json files, a docids file and a topics
+    xml file. A third of the documents only have a pdf parse, a third only a pmc parse and a third both.
+    :param folder_path: the folder to write the collection to
+    :param n_docs: the number of documents
+    :param n_topics: the number of topics
+    :param vocabulary: the words the texts are drawn from
+    :param rng: a random.Random instance
+    :param paragraphs: the (min, max) number of paragraphs per document
+    :param paragraph_words: the (min, max) number of words per paragraph
+    :return: None
+    """
+
+    def text(n):
+        return ' '.join(rng.choice(vocabulary) for _ in range(n))
+
+    os.makedirs(os.path.join(folder_path, 'document_parses', 'pdf_json'), exist_ok=True)
+    os.makedirs(os.path.join(folder_path, 'document_parses', 'pmc_json'), exist_ok=True)
+
+    rows = []
+    for i in range(n_docs):
+        cord_uid, sha, pmcid = 'b%07d' % i, '%040x' % i, 'PMC%07d' % i
+        doc = {'metadata': {'title': text(10)},
+               'body_text': [{'text': text(rng.randint(*paragraph_words))} for _ in range(rng.randint(*paragraphs))]}
+        row = dict.fromkeys(METADATA_COLUMNS, '')
+        row.update(cord_uid=cord_uid, title=doc['metadata']['title'], abstract=text(150))
+
+        if i % 3 != 1:
+            row['sha'] = sha
+            row['pdf_json_files'] = 'document_parses/pdf_json/%s.json' % sha
+            with open(os.path.join(folder_path, row['pdf_json_files']), 'w') as file_handle:
+                json.dump(doc, file_handle)
+        if i % 3 != 0:
+            row['pmcid'] = pmcid
+            row['pmc_json_files'] = 'document_parses/pmc_json/%s.xml.json' % pmcid
+            with open(os.path.join(folder_path, row['pmc_json_files']), 'w') as file_handle:
+                json.dump(doc, file_handle)
+        rows.append(row)
+
+    with open(os.path.join(folder_path, 'metadata.csv'), 'w', newline='') as file_handle:
+        writer = csv.DictWriter(file_handle, METADATA_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    with open(os.path.join(folder_path, 'docids.txt'), 'w') as file_handle:
+        file_handle.write('\n'.join(row['cord_uid'] for row in rows) + '\n')
+
+    with open(os.path.join(folder_path, 'topics.xml'), 'w') as file_handle:
+        file_handle.write('<topics>\n')
+        for n in range(1, n_topics + 1):
+            file_handle.write('<topic number="%s"><query>%s</query><question>%s</question><narrative>%s</narrative>'
+                              '</topic>\n' % (n, text(4), text(12), text(30)))
+        file_handle.write('</topics>\n')
+
+
+def create_tiny_model(folder_path, vocabulary, hidden_size = 64, layers = 2, heads = 2, max_position_embeddings = 512):
+    """
+    Saves a randomly initialized BERT and a word-level vocabulary covering the synthetic texts, loadable with
+    BertSimilarity(folder_path)
+    :return: None
+    """
+
+    from transformers import BertConfig, BertModel, BertTokenizer
+
+    os.makedirs(folder_path, exist_ok=True)
+    tokens = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + list(string.ascii_lowercase + string.digits) + vocabulary
+    with open(os.path.join(folder_path, 'vocab.txt'), 'w') as file_handle:
+        file_handle.write('\n'.join(tokens) + '\n')
+    BertTokenizer(os.path.join(folder_path, 'vocab.txt')).save_pretrained(folder_path)
+
+    config = BertConfig(vocab_size=len(tokens), hidden_size=hidden_size, num_hidden_layers=layers,
+                        num_attention_heads=heads, intermediate_size=4 * hidden_size,
+                        max_position_embeddings=max_position_embeddings)
+    BertModel(config).save_pretrained(folder_path)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class Stage():
+    def __init__(self, report, name):
+        self.report = report
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.report[self.name] = {'seconds': time.perf_counter() - self.start, 'peak_rss_mb': peak_rss_mb()}
+
+    def rate(self, unit, count):
+        self.report[self.name][unit + '_per_sec'] = count / max(self.report[self.name]['seconds'], 1e-9)
+        self.report[self.name][unit] = count
+
+
+def run_benchmark(workdir, n_docs = 1000, n_topics = 5, rank_docs = 200, vocabulary_size = 5000, hidden_size = 64,
+                  layers = 2, batch_size = 32, workers = 1, backend = 'fp32', token_budget = None, seed = 0,
+                  from_json = False, prefetch_workers = 0):
+    """
+    Generates the fixtures and the tiny model, then times ingestion, tokenization, chunking, encoding, ranking and
+    top-k selection
+    :return: a dict with the latency, throughput and peak RSS of every stage
+    """
+
+    from model import BertSimilarity, RankerManager
+
+    rng = random.Random(seed)
+    data_folder = os.path.join(workdir, 'data') + '/'
+    model_folder = os.path.join(workdir, 'model')
+    report = {'config': {'docs': n_docs, 'topics': n_topics, 'rank_docs': rank_docs, 'hidden_size': hidden_size,
+                         'layers': layers, 'batch_size': batch_size, 'workers': workers, 'backend': backend,
+                         'token_budget': token_budget, 'from_json': from_json,
+                         'prefetch_workers': prefetch_workers}}
+
+    vocabulary = make_vocabulary(vocabulary_size, rng)
+    with Stage(report, 'fixtures'):
+        generate_fixtures(data_folder, n_docs, n_topics, vocabulary, rng)
+        create_tiny_model(model_folder, vocabulary, hidden_size, layers)
+
+    cov_dm = TrecCovidDatasetManager(data_folder, data_folder + 'metadata.csv')
+    with Stage(report, 'metadata') as stage:
+        cov_dm.load_metadata_from_csv_round3()
+    stage.rate('docs', len(cov_dm.metadata_dict))
+
+    with Stage(report, 'ingestion') as stage:
+        cov_dm.create_docs_store(workers)
+    stage.rate('docs', len(cov_dm.paper_dict))
+
+    ranker = BertSimilarity(model_folder, batch_size=batch_size, backend=backend)
+    valid_docs = cov_dm.get_valid_docs()
+    texts = [cov_dm.get_document_from_dict_no_paragraph_list(cord_uid)['text'] for cord_uid in valid_docs]
+
+    with Stage(report, 'tokenization') as stage:
+        doc_ids = [ranker.tokenize_doc(text) for text in texts]
+    stage.rate('docs', len(doc_ids))
+    stage.rate('tokens', sum(len(ids) for ids in doc_ids))
+
+    maxlen = ranker.config.max_position_embeddings - 2
+    with Stage(report, 'chunking') as stage:
+        chunks = [split_doc(ids, maxlen)[0] for ids in doc_ids]
+    stage.rate('chunks', sum(len(c) for c in chunks))
+
+    sample = texts[:rank_docs]
+    with Stage(report, 'encoding') as stage:
+        ranker.encode_docs(sample)
+    stage.rate('docs', len(sample))
+    stage.rate('chunks', sum(len(c) for c in chunks[:rank_docs]))
+
+    manager = RankerManager(ranker, TopicCollection(data_folder + 'topics.xml'), cov_dm, valid_docs[:rank_docs],
+                            output=os.path.join(workdir, 'bench_run.txt'), batch_size=batch_size, workers=workers,
+                            token_budget=token_budget, from_json=from_json, prefetch_workers=prefetch_workers)
+    with Stage(report, 'ranking') as stage:
+        manager.manage_rank()
+    stage.rate('pairs', len(manager.topics.topics) * len(manager.valid_docs))
+    counters = manager.metrics.counters
+    report['ranking']['padding_waste'] = 1 - counters.get('tokens', 0) / max(counters.get('batch_tokens', 0), 1)
+
+    scores = np.random.RandomState(seed).rand(n_topics, n_docs)
+    with Stage(report, 'top_k') as stage:
+        accumulator = TopKAccumulator(1000)
+        for t in range(n_topics):
+            for position, score in enumerate(scores[t].tolist()):
+                accumulator.push(str(t), position, score, position)
+        accumulator.ranked()
+    stage.rate('scores', scores.size)
+
+    report['peak_rss_mb'] = peak_rss_mb()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the ranking pipeline on synthetic CORD-19 fixtures')
+    parser.add_argument('--docs', type=int, default=1000)
+    parser.add_argument('--topics', type=int, default=5)
+    parser.add_argument('--rank-docs', type=int, default=200, help='documents ranked and encoded by BERT')
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--hidden-size', type=int, default=64)
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--backend', default='fp32', choices=['fp32', 'int8', 'torchscript', 'onnx'])
+    parser.add_argument('--token-budget', type=int, default=None, help='batch chunks by length up to this many tokens')
+    parser.add_argument('--from-json', action='store_true', help='rank reading the json files instead of the store')
+    parser.add_argument('--prefetch-workers', type=int, default=0, help='threads reading and tokenizing docs ahead')
+    parser.add_argument('--workdir', default=None, help='keep the fixtures in this folder instead of a temporary one')
+    parser.add_argument('--output', default=None, help='write the report to this json file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        result = run_benchmark(args.workdir or tmp, args.docs, args.topics, args.rank_docs, args.vocabulary,
+                               args.hidden_size, args.layers, args.batch_size, args.workers, args.backend,
+                               args.token_budget, from_json=args.from_json, prefetch_workers=args.prefetch_workers)
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
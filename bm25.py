@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import re
+import json
+import math
+from collections import Counter
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both but by
+can could did do does doing down during each few for from further had has have having he her here hers herself him
+himself his how i if in into is it its itself just me more most my myself no nor not now of off on once only or other
+our ours ourselves out over own same she should so some such than that the their theirs them themselves then there
+these they this those through to too under until up very was we were what when where which while who whom why will
+with would you your yours yourself yourselves also may however using used use et al fig figure table
+""".split())
+
+
+def tokenize(text):
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if len(t) > 1 and t not in STOPWORDS]
+
+
+class BM25Index():
+    """
+    BM25 inverted index over the title, abstract and body of the documents. The postings of every term are stored
+    contiguously in two flat arrays, uint32 document numbers and uint16 term frequencies, addressed by an array of
+    offsets per term, so the whole index is a handful of memory-mapped numpy files.
+    """
+
+    def __init__(self, folder_path, k1 = 0.9, b = 0.4):
+        self.folder_path = folder_path
+        self.k1 = k1
+        self.b = b
+        self.uids = []
+        self.uid_rows = {}
+        self.vocabulary = {}
+        self.offsets = None
+        self.postings_docs = None
+        self.postings_tfs = None
+        self.doc_lengths = None
+        self.avg_doc_length = 0
+
+    def __contains__(self, cord_uid):
+        return cord_uid in self.uid_rows
+
+    def __len__(self):
+        return len(self.uids)
+
+    def _get_fields(self, docs, cord_uid):
+        metadata = docs.metadata_dict[cord_uid] if cord_uid in docs.metadata_dict else {}
+        fields = [metadata.get('title'), metadata.get('abstract'),
+                  docs.get_document_from_dict_no_paragraph_list(cord_uid)['text']]
+        return ' '.join(field for field in fields if isinstance(field, str))
+
+    # Indexes the title, abstract and body of every document
+    def build(self, docs, valid_docs):
+        """
+        Tokenizes the title and abstract from the metadata and the body text of every valid document and writes the
+        inverted index to disk. Documents that can not be read are skipped.
+        :param docs: the TrecCovidDatasetManager holding the metadata and the documents
+        :param valid_docs: the cord_uid's of the documents to index
+        :return: None
+        """
+
+        term_ids, doc_terms, doc_tfs, doc_lengths = {}, [], [], []
+        self.uids = []
+        for i, cord_uid in enumerate(valid_docs):
+            try:
+                tokens = tokenize(self._get_fields(docs, cord_uid))
+            except Exception as e:
+                print("Skipping doc %s, %s: %s" % (i, cord_uid, e))
+                continue
+
+            counts = Counter(tokens)
+            doc_terms.append(np.array([term_ids.setdefault(t, len(term_ids)) for t in counts], dtype=np.int64))
+            doc_tfs.append(np.minimum(np.fromiter(counts.values(), dtype=np.int64, count=len(counts)), 65535))
+            doc_lengths.append(len(tokens))
+            self.uids.append(cord_uid)
+
+        # Group the (term, doc, tf) triples by term, docs stay in increasing order inside every postings list
+        terms = np.concatenate(doc_terms) if doc_terms else np.zeros(0, dtype=np.int64)
+        postings_docs = np.repeat(np.arange(len(doc_terms), dtype=np.uint32), [len(t) for t in doc_terms])
+        postings_tfs = np.concatenate(doc_tfs).astype(np.uint16) if doc_tfs else np.zeros(0, dtype=np.uint16)
+        order = np.argsort(terms, kind='stable')
+
+        os.makedirs(self.folder_path, exist_ok=True)
+        np.save(os.path.join(self.folder_path, 'postings_docs.npy'), postings_docs[order])
+        np.save(os.path.join(self.folder_path, 'postings_tfs.npy'), postings_tfs[order])
+        np.save(os.path.join(self.folder_path, 'offsets.npy'),
+                np.concatenate([[0], np.cumsum(np.bincount(terms, minlength=len(term_ids)))]).astype(np.int64))
+        np.save(os.path.join(self.folder_path, 'doc_lengths.npy'), np.array(doc_lengths, dtype=np.uint32))
+        with open(os.path.join(self.folder_path, 'index.json'), 'w') as file_handle:
+            json.dump({'uids': self.uids, 'terms': sorted(term_ids, key=term_ids.get), 'k1': self.k1, 'b': self.b},
+                      file_handle)
+
+        self.load()
+
+    def load(self):
+        """
+        Loads the vocabulary and memory-maps the postings
+        :return: None
+        """
+
+        with open(os.path.join(self.folder_path, 'index.json')) as file_handle:
+            index = json.load(file_handle)
+
+        self.uids = index['uids']
+        self.uid_rows = {cord_uid: row for row, cord_uid in enumerate(self.uids)}
+        self.vocabulary = {term: term_id for term_id, term in enumerate(index['terms'])}
+        self.k1 = index['k1']
+        self.b = index['b']
+        self.offsets = np.load(os.path.join(self.folder_path, 'offsets.npy'))
+        self.postings_docs = np.load(os.path.join(self.folder_path, 'postings_docs.npy'), mmap_mode='r')
+        self.postings_tfs = np.load(os.path.join(self.folder_path, 'postings_tfs.npy'), mmap_mode='r')
+        self.doc_lengths = np.load(os.path.join(self.folder_path, 'doc_lengths.npy')).astype(np.float32)
+        self.avg_doc_length = float(self.doc_lengths.mean()) if len(self.doc_lengths) else 0.
+
+    def get_mask(self, cord_uids):
+        """
+        Builds a boolean mask over the indexed documents
+        :param cord_uids: the ids of the documents to keep
+        :return: a boolean array with one entry per indexed document
+        """
+
+        mask = np.zeros(len(self.uids), dtype=bool)
+        mask[[self.uid_rows[cord_uid] for cord_uid in cord_uids if cord_uid in self.uid_rows]] = True
+        return mask
+
+    def score(self, query):
+        """
+        Computes the BM25 score of every indexed document for a query
+        :param query: the query text
+        :return: a float32 array with one score per indexed document
+        """
+
+        scores = np.zeros(len(self.uids), dtype=np.float32)
+        norms = self.k1 * (1 - self.b + self.b * self.doc_lengths / max(self.avg_doc_length, 1e-9))
+        for term in set(tokenize(query)):
+            if term not in self.vocabulary:
+                continue
+            term_id = self.vocabulary[term]
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            postings_docs = self.postings_docs[start: end]
+            tfs = self.postings_tfs[start: end].astype(np.float32)
+
+            idf = math.log(1 + (len(self.uids) - (end - start) + 0.5) / ((end - start) + 0.5))
+            # Every doc appears once in a postings list, so the fancy-indexed add is safe
+            scores[postings_docs] += idf * tfs * (self.k1 + 1) / (tfs + norms[postings_docs])
+        return scores
+
+    def search(self, query, n, mask = None):
+        """
+        Retrieves the n best documents for a query
+        :param query: the query text
+        :param n: the number of documents to retrieve
+        :param mask: optional boolean mask from get_mask restricting the candidate documents
+        :return: a list of (cord_uid, score) pairs, best first, only documents matching some query term
+        """
+
+        scores = self.score(query)
+        if mask is not None:
+            scores[~mask] = 0
+        n = min(n, int(np.count_nonzero(scores)))
+        if n == 0:
+            return []
+
+        best = np.argpartition(-scores, n - 1)[:n]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return [(self.uids[row], float(scores[row])) for row in best]
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+class TokenCache():
+    """
+    Persistent cache of the token ids of every document, keyed by cord_uid. The ids of all the documents are appended
+    to a single uint32 file that is memory-mapped on load, with the cord_uid -> (start, end) mapping in index.json.
+    New entries are buffered in memory and appended on flush. The ids are stored unchunked, the chunk size depends on
+    the query length and is applied when the documents are ranked.
+    """
+
+    def __init__(self, folder_path, flush_every = 1000):
+        self.folder_path = folder_path
+        self.ids_file_path = os.path.join(folder_path, 'ids.u32')
+        self.index_file_path = os.path.join(folder_path, 'index.json')
+        self.flush_every = flush_every
+        self.tokenizer_name = None
+        self.doc_ranges = {}
+        self.rows = 0
+        self.ids = None
+        self.pending = {}
+        # Ranking workers share the cache read-only, only the main process appends to the files
+        self.read_only = False
+
+    def __contains__(self, cord_uid):
+        return cord_uid in self.pending or cord_uid in self.doc_ranges
+
+    def __len__(self):
+        return len(self.doc_ranges) + len([cord_uid for cord_uid in self.pending if cord_uid not in self.doc_ranges])
+
+    def load(self):
+        """
+        Loads the cord_uid index and memory-maps the token ids, if the cache was already created
+        :return: None
+        """
+
+        if not os.path.isfile(self.index_file_path):
+            return
+
+        with open(self.index_file_path) as file_handle:
+            index = json.load(file_handle)
+        self.tokenizer_name = index['tokenizer']
+        self.doc_ranges = {cord_uid: tuple(rows) for cord_uid, rows in index['docs'].items()}
+        self.rows = index['rows']
+        self.ids = np.memmap(self.ids_file_path, dtype=np.uint32, mode='r', shape=(self.rows,)) if self.rows else None
+
+    # Ties the cache to a tokenizer, ids produced by another vocabulary would be meaningless
+    def bind(self, tokenizer_name):
+        if self.tokenizer_name is not None and self.tokenizer_name != tokenizer_name and self.doc_ranges:
+            raise Exception("Token cache was built with tokenizer %s, not %s" % (self.tokenizer_name, tokenizer_name))
+        self.tokenizer_name = tokenizer_name
+
+    def get(self, cord_uid):
+        """
+        Given a cord_uid returns its token ids
+        :param cord_uid: The id of the document
+        :return: an array of token ids, or None if the document is not cached
+        """
+
+        if cord_uid in self.pending:
+            return self.pending[cord_uid]
+        if cord_uid in self.doc_ranges:
+            start, end = self.doc_ranges[cord_uid]
+            return self.ids[start: end]
+        return None
+
+    def put(self, cord_uid, ids):
+        if self.read_only:
+            return
+        self.pending[cord_uid] = np.asarray(ids, dtype=np.uint32)
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def remove(self, cord_uids):
+        """
+        Drops documents from the cache, i.e. after they changed between rounds
+        :param cord_uids: The ids of the documents to drop
+        :return: None
+        """
+
+        for cord_uid in cord_uids:
+            self.pending.pop(cord_uid, None)
+            self.doc_ranges.pop(cord_uid, None)
+        self.flush()
+
+    def flush(self):
+        """
+        Appends the buffered entries to the ids file and saves the index
+        :return: None
+        """
+
+        if self.read_only:
+            return
+
+        os.makedirs(self.folder_path, exist_ok=True)
+        # Ids written by an interrupted flush are not in the index, the new ones must start right after the indexed
+        if os.path.isfile(self.ids_file_path) and os.path.getsize(self.ids_file_path) > self.rows * 4:
+            os.truncate(self.ids_file_path, self.rows * 4)
+
+        rows, doc_ranges = self.rows, {}
+        with open(self.ids_file_path, 'ab') as file_handle:
+            for cord_uid, ids in self.pending.items():
+                file_handle.write(ids.tobytes())
+                doc_ranges[cord_uid] = (rows, rows + len(ids))
+                rows += len(ids)
+        self.doc_ranges.update(doc_ranges)
+        self.rows = rows
+        self.pending = {}
+
+        with open(self.index_file_path, 'w') as file_handle:
+            json.dump({'tokenizer': self.tokenizer_name, 'rows': self.rows, 'docs': self.doc_ranges}, file_handle)
+        self.load()
+
+    # Tokenizes the whole collection ahead of the ranking runs
+    def build(self, ranker, docs, valid_docs):
+        """
+        Tokenizes every valid document that is not cached yet
+        :param ranker: a model exposing tokenize_doc and bound to this cache, i.e. BertSimilarity
+        :param docs: the TrecCovidDatasetManager holding the documents
+        :param valid_docs: the cord_uid's of the documents to tokenize
+        :return: None
+        """
+
+        for i, cord_uid in enumerate(valid_docs):
+            if cord_uid in self:
+                continue
+            try:
+                ranker.tokenize_doc(docs.get_document_from_dict_no_paragraph_list(cord_uid)['text'], cord_uid)
+            except Exception as e:
+                print("Skipping doc %s, %s: %s" % (i, cord_uid, e))
+        self.flush()
+
+
+class QueryEmbeddingCache():
+    """
+    Persistent cache of query embeddings, one .npy file per query named after the hash of the model, the inference
+    backend and the query text, so the topics of a round are only encoded by the first run.
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+
+    def key(self, model_name, backend, text):
+        return hashlib.sha1(('%s\n%s\n%s' % (model_name, backend, text)).encode('utf-8')).hexdigest()
+
+    def _file_path(self, key):
+        return os.path.join(self.folder_path, key + '.npy')
+
+    def get(self, key):
+        """
+        Given a query hash returns its embedding
+        :param key: the hash returned by key
+        :return: an array, or None if the query is not cached
+        """
+
+        if not os.path.isfile(self._file_path(key)):
+            return None
+        return np.load(self._file_path(key))
+
+    def put(self, key, embed):
+        os.makedirs(self.folder_path, exist_ok=True)
+        # Written aside and renamed, so concurrent runs never read a partial file
+        tmp_path = self._file_path(key) + '.%s.tmp' % os.getpid()
+        with open(tmp_path, 'wb') as file_handle:
+            np.save(file_handle, np.asarray(embed, dtype=np.float32))
+        os.replace(tmp_path, self._file_path(key))
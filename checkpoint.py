@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import glob
+import time
+
+from utils import TopKAccumulator
+
+
+class RankCheckpoint():
+    """
+    Append-only log of the scored (topic, doc) pairs of a ranking run, one 'qid docid position score' line per pair.
+    Lines are buffered and appended every flush_every pairs or flush_seconds seconds. Worker processes write to their
+    own file next to the main one, and loading reads all of them. A truncated last line left by a crash is ignored.
+    Logged scores are reused as they are, so a resumed run gives the same ranking as an uninterrupted one up to float
+    noise in the scores of the pairs scored after the resume, not a byte-identical run file.
+    """
+
+    def __init__(self, file_path, flush_every = 1000, flush_seconds = 60.):
+        self.file_path = file_path
+        self.write_path = file_path
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.pending = []
+        self.last_flush = time.time()
+        self.done = {}
+
+    # A copy writing to its own file, for a worker process
+    def for_worker(self, worker_id):
+        worker = RankCheckpoint(self.file_path, self.flush_every, self.flush_seconds)
+        worker.write_path = '%s.%s' % (self.file_path, worker_id)
+        worker.done = self.done
+        return worker
+
+    def load(self, k, pairs = None):
+        """
+        Reads every log of the run, remembering the scored pairs so they can be skipped
+        :param k: the number of documents to keep per topic
+        :param pairs: optional dict of qid -> set of docids ranked by the current run. Logged pairs outside of it were
+        scored for other topics or documents and are ignored, they are neither returned nor skipped
+        :return: a TopKAccumulator with the logged scores
+        """
+
+        result = TopKAccumulator(k)
+        self.done = {}
+        for file_path in glob.glob(glob.escape(self.file_path)) + glob.glob(glob.escape(self.file_path) + '.*'):
+            with open(file_path) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) != 4 or not line.endswith('\n'):
+                        continue
+                    qid, docid, position, score = fields
+                    if pairs is not None and docid not in pairs.get(qid, ()):
+                        continue
+                    result.push(qid, docid, float(score), int(position))
+                    self.done.setdefault(qid, set()).add(docid)
+        return result
+
+    def is_done(self, qid, docid):
+        return docid in self.done.get(qid, ())
+
+    def append(self, qid, docid, position, score):
+        # repr keeps every digit of the logged score. A resumed run still ranks the same only up to float noise: the
+        # skipped pairs change the padding of the batches of the remaining ones and their scores move in the last bits
+        self.pending.append('%s %s %s %r\n' % (qid, docid, position, float(score)))
+        if len(self.pending) >= self.flush_every or time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with open(self.write_path, 'a') as f:
+                f.write(''.join(self.pending))
+                f.flush()
+                os.fsync(f.fileno())
+            self.pending = []
+        self.last_flush = time.time()
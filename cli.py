@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Lightweight commands that never import torch, transformers or pandas, so they start in well under a second:
+#   python cli.py topics ./data/round3/topics-rnd3.xml
+#   python cli.py validate-docids ./data/round3/docids-rnd3.txt --metadata ./data/round3/metadata.csv
+#   python cli.py inspect ./data/round3/docs_store/ ./data/round3/embeddings/ run.checkpoint
+
+import os
+import csv
+import sys
+import json
+import argparse
+
+
+def list_topics(args):
+    from data import TopicCollection
+
+    topics = TopicCollection(args.topics)
+    for qid, topic in topics.topics.items():
+        print("%s\t%s" % (qid, topic.query))
+        if args.verbose:
+            print("\t%s\n\t%s" % (topic.question, topic.narrative))
+    print("%s topics" % len(topics.topics), file=sys.stderr)
+
+
+def validate_docids(args):
+    from data import read_valid_docs
+
+    docids = read_valid_docs(args.docids)
+    duplicates = len(docids) - len(set(docids))
+    known = {}
+    if args.metadata:
+        # The csv module is enough to read one column, pandas would take longer to import than to read it
+        with open(args.metadata, newline='') as file_handle:
+            known['metadata'] = {row['cord_uid'] for row in csv.DictReader(file_handle)}
+    if args.store:
+        from doc_store import DocumentStore
+        store = DocumentStore(args.store)
+        store.load()
+        known['store'] = set(store.uid_rows)
+
+    missing = 0
+    for source, uids in known.items():
+        absent = [docid for docid in docids if docid not in uids]
+        missing += len(absent)
+        print("%s: %s of %s docids found, %s missing" % (source, len(docids) - len(absent), len(docids), len(absent)))
+        for docid in absent[:args.show]:
+            print("\t%s" % docid)
+    print("%s duplicated docids" % duplicates)
+    return 1 if missing or duplicates else 0
+
+
+def _size_mb(*file_paths):
+    return sum(os.path.getsize(p) for p in file_paths if os.path.isfile(p)) / 2 ** 20
+
+
+def describe_store(path):
+    """
+    Recognizes a store by its files and summarizes it
+    :param path: the folder of a store or index, or a checkpoint log file
+    :return: a dict with the kind of store and its statistics
+    """
+
+    if os.path.isfile(path):
+        qids, pairs = set(), 0
+        with open(path) as file_handle:
+            for line in file_handle:
+                fields = line.split()
+                if len(fields) == 4 and line.endswith('\n'):
+                    qids.add(fields[0])
+                    pairs += 1
+        return {'kind': 'checkpoint', 'topics': len(qids), 'pairs': pairs, 'size_mb': _size_mb(path)}
+
+    def exists(file_name):
+        return os.path.isfile(os.path.join(path, file_name))
+
+    files = [os.path.join(path, file_name) for file_name in os.listdir(path)]
+    if exists('text.bin'):
+        from doc_store import DocumentStore
+        store = DocumentStore(path)
+        store.load()
+        return {'kind': 'documents store', 'documents': len(store), 'deleted': len(store.deleted),
+                'paragraphs': len(store.paragraphs) if store.paragraphs is not None else 0,
+                'text_mb': len(store.text) / 2 ** 20, 'size_mb': _size_mb(*files)}
+    if exists('embeddings.f32'):
+        from embeddings import DocumentEmbeddingIndex
+        index = DocumentEmbeddingIndex(path)
+        index.load()
+        return {'kind': 'embedding index', 'documents': len(index), 'chunks': index.rows, 'dim': index.dim,
+                'size_mb': _size_mb(*files)}
+    if exists('centroids.npy'):
+        from ann import IVFIndex
+        ann = IVFIndex(path)
+        ann.load()
+        return {'kind': 'ivf index', 'level': ann.level, 'documents': len(ann), 'lists': len(ann.centroids),
+                'rows': len(ann.row_docs), 'size_mb': _size_mb(*files)}
+    if exists('ids.u32'):
+        from cache import TokenCache
+        cache = TokenCache(path)
+        cache.load()
+        return {'kind': 'token cache', 'tokenizer': cache.tokenizer_name, 'documents': len(cache),
+                'tokens': cache.rows, 'size_mb': _size_mb(*files)}
+    if exists('postings_docs.npy'):
+        from bm25 import BM25Index
+        index = BM25Index(path)
+        index.load()
+        return {'kind': 'bm25 index', 'documents': len(index), 'terms': len(index.vocabulary),
+                'postings': len(index.postings_docs), 'size_mb': _size_mb(*files)}
+    if any(file_name.endswith('.npy') for file_name in os.listdir(path)):
+        return {'kind': 'query embeddings cache', 'queries': len([f for f in files if f.endswith('.npy')]),
+                'size_mb': _size_mb(*files)}
+    raise Exception("%s is not a known store" % path)
+
+
+def inspect_stores(args):
+    status = 0
+    for path in args.paths:
+        try:
+            print("%s: %s" % (path, json.dumps(describe_store(path))))
+        except Exception as e:
+            print("%s: %s" % (path, e))
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect the topics, docids and stores of the collection')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    topics_parser = commands.add_parser('topics', help='list the topics of a topics xml file')
+    topics_parser.add_argument('topics')
+    topics_parser.add_argument('--verbose', action='store_true', help='also print the question and narrative')
+    topics_parser.set_defaults(run=list_topics)
+
+    validate_parser = commands.add_parser('validate-docids', help='check a docids file against the collection')
+    validate_parser.add_argument('docids')
+    validate_parser.add_argument('--metadata', default=None, help='metadata.csv file')
+    validate_parser.add_argument('--store', default=None, help='documents store folder')
+    validate_parser.add_argument('--show', type=int, default=10, help='missing docids to print')
+    validate_parser.set_defaults(run=validate_docids)
+
+    inspect_parser = commands.add_parser('inspect', help='summarize stores, indexes, caches and checkpoint logs')
+    inspect_parser.add_argument('paths', nargs='+')
+    inspect_parser.set_defaults(run=inspect_stores)
+
+    args = parser.parse_args()
+    sys.exit(args.run(args) or 0)
@@ -1,42 +1,37 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import re
-import os
-import json
-import gzip
-import tarfile
-import itertools as itt
-
 from xml.etree import ElementTree
-from tqdm import tqdm
 
 METADATA = "./data/round2/metadata.csv"
 TOPICS = "./data/round2/topics-rnd2.xml"
 VALID_DOCS = "./data/round2/docids-rnd2.txt"
 QRELS = "./data/round1/qrels-rnd2.txt"
 
+# tqdm is only imported once a file is actually read
+def _progress(iterable, desc):
+    from tqdm import tqdm
+    return tqdm(iterable, desc=desc, leave=False)
+
 def read_qrels(filepath = QRELS):
-    result = {}
     res = []
     with open(filepath) as f:
-        for line in tqdm(f, desc='loading qrels (by line)', leave=False):
+        for line in _progress(f, 'loading qrels (by line)'):
             qid, _, docid, score = line.split()
-            result.setdefault(qid, {})[docid] = int(score)
             res.append([qid, docid, score])
     return res
 
 def read_valid_docs(filepath = VALID_DOCS):
     with open(filepath) as f:
-        doc_ids = [line.strip() for line in tqdm(f, desc='loading qrels (by line)', leave=False)]
+        doc_ids = [line.strip() for line in _progress(f, 'loading qrels (by line)')]
     return doc_ids
 
 def read_qrels_dict(file):
     result = {}
-    file = open(file)
-    for line in tqdm(file, desc='loading qrels (by line)', leave=False):
-        qid, _, docid, score = line.split()
-        result.setdefault(qid, {})[docid] = int(score)
+    with open(file) as f:
+        for line in _progress(f, 'loading qrels (by line)'):
+            qid, _, docid, score = line.split()
+            result.setdefault(qid, {})[docid] = int(score)
     return result
 
 class Topic():
@@ -53,13 +48,26 @@ class Topic():
 class TopicCollection():    
     def __init__(self, filepath = TOPICS):
         self.topics = {}
-        tree = ElementTree.parse(filepath)
-        for child in tree.getroot():
+        if filepath is not None:
+            self.add_topics(ElementTree.parse(filepath).getroot())
+
+    # Topics given as an xml string, i.e. posted to the query service
+    @classmethod
+    def from_xml(cls, xml):
+        collection = cls(None)
+        collection.add_topics(ElementTree.fromstring(xml))
+        return collection
+
+    def add_topics(self, root):
+        for child in root:
             n = child.attrib['number']
-            query = child.find('query').text
-            question = child.find('question').text
-            narrative = child.find('narrative').text
+            query = child.findtext('query', '')
+            question = child.findtext('question', '')
+            narrative = child.findtext('narrative', '')
             self.topics[n] = Topic(n, query, question, narrative)
+
+    def add_topic(self, topic):
+        self.topics[topic.index] = topic
      
     def __length__(self):
         return len(self.topics)
@@ -1,9 +1,124 @@
 import json
 import os
 import io
-import pandas as pd
+import math
+import time
 import pickle
-import numpy as np
+import itertools
+from string import Formatter
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+
+from doc_store import DocumentStore
+
+# orjson parses the CORD-19 files several times faster than the standard library when it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# pandas is only imported to read the metadata csv, the documents and the stores do not need it
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+# Layout of metadata.csv in every round. A document path is either read from a column or built from a template over
+# other columns, in that case only for the rows whose flag column is 'True'.
+METADATA_SCHEMAS = {
+    'round2': {
+        'pmc_file': {'template': '{full_text_file}/pmc_json/{pmcid}.xml.json', 'flag': 'has_pmc_xml_parse'},
+        'pdf_file': {'template': '{full_text_file}/pdf_json/{sha}.json', 'flag': 'has_pdf_parse'},
+    },
+    'round3': {
+        'pmc_file': {'column': 'pmc_json_files'},
+        'pdf_file': {'column': 'pdf_json_files'},
+    },
+}
+
+
+def _get_path_columns(spec):
+    if 'column' in spec:
+        return [spec['column']]
+    fields = [field for _, field, _, _ in Formatter().parse(spec['template']) if field]
+    return fields + [spec['flag']]
+
+
+def _first_value(column):
+    # Some registries list several files or shas separated by ';', the first one is used
+    return column.str.split(';').str[0].str.strip()
+
+
+def _build_paths(df, spec):
+    """
+    Builds the relative path of a document file for every registry of the metadata
+    :param df: the metadata DataFrame
+    :param spec: a path specification from METADATA_SCHEMAS
+    :return: a Series of paths, NaN for the registries without the file
+    """
+
+    import pandas as pd
+
+    if 'column' in spec:
+        return _first_value(df[spec['column']])
+
+    paths = pd.Series('', index=df.index)
+    for literal, field, _, _ in Formatter().parse(spec['template']):
+        paths = paths + literal
+        if field:
+            paths = paths + _first_value(df[field])
+    return paths.where(df[spec['flag']] == 'True')
+
+
+class MetadataTable(Mapping):
+    """
+    Read-only mapping view over the metadata table, so the table can be used where the dict of dicts was. Each
+    registry is returned as a dict with its title, abstract, pmc_file and pdf_file.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.columns = {column: table[column].to_numpy() for column in table.columns}
+
+    def __getitem__(self, cord_uid):
+        i = self.table.index.get_loc(cord_uid)
+        return {column: values[i] for column, values in self.columns.items()}
+
+    def __contains__(self, cord_uid):
+        return cord_uid in self.table.index
+
+    def __iter__(self):
+        return iter(self.table.index)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getstate__(self):
+        return {'table': self.table}
+
+    def __setstate__(self, state):
+        self.__init__(state['table'])
+
+
+def _parse_paper_json(file_path):
+    """
+    Parses a CORD-19 json document. It is a module function so it can be sent to the ingestion worker processes.
+    :param file_path: the full path of the json document
+    :return: a dictionary containing the document title and the list of paragraphs of its body
+    """
+
+    with io.open(file=file_path, mode='rb') as doc_json_file:
+        raw = doc_json_file.read()
+    doc_json = orjson.loads(raw) if orjson is not None else json.loads(raw.decode('utf-8'))
+
+    paper_title = doc_json['metadata']['title']
+    paper_body_text = [t['text'] for t in doc_json['body_text']]
+    return {'title': paper_title, 'text': paper_body_text}
+
+
+# Parses a chunk of documents in one call, so the ingestion workers are not sent one file at a time
+def _parse_papers_json(file_paths):
+    return [_parse_paper_json(file_path) for file_path in file_paths]
 
 
 class TrecCovidDatasetManager:
@@ -13,39 +128,71 @@ class TrecCovidDatasetManager:
         self.data_folder_path = data_folder_path
         self.metadata_dict = {}
         self.paper_dict = {}
+        self.document_files = None
 
-    # Reads the metadata file and store its information in a dict
-    def load_metadata_from_csv_round3(self):
+    # Lists every json document under the data folder once, so file checks become set lookups
+    def list_document_files(self):
         """
-        Load the registries from the metadata file in csv format to a dictionary. This method should be executed before
-        trying to retrieve any document from the collection
+        Walks the data folder once and keeps the relative paths of all the json documents in memory. Once listed,
+        every existence check of a document file is a set lookup instead of a syscall.
         :return: None
         """
 
-        df = pd.read_csv(self.metadata_file_path, low_memory=False, dtype=str)
+        document_files = set()
+        for dir_path, _, file_names in os.walk(self.data_folder_path):
+            rel_dir = os.path.relpath(dir_path, self.data_folder_path)
+            for file_name in file_names:
+                if file_name.endswith('.json'):
+                    document_files.add(file_name if rel_dir == '.' else rel_dir.replace(os.sep, '/') + '/' + file_name)
+        self.document_files = document_files
+
+    def _file_exists(self, doc_file_path):
+        if self.document_files is not None:
+            return doc_file_path in self.document_files
+        return os.path.isfile(self.data_folder_path + doc_file_path)
+
+    # Reads the metadata file into a compact table indexed by cord_uid
+    def load_metadata_from_csv(self, schema='round3'):
+        """
+        Load the registries from the metadata file in csv format to a table indexed by cord_uid. Only the columns the
+        given schema needs are read, the document paths are built column-wise and checked against the listing of the
+        data folder, and the first valid registry of every cord_uid is kept. This method should be executed before
+        trying to retrieve any document from the collection.
+        :param schema: the key of the metadata layout in METADATA_SCHEMAS, i.e. 'round2' or 'round3'
+        :return: None
+        """
 
-        for index, cord_uid, sha, source_x, title, doi, pmcid, pubmed_id, license, abstract, publish_time, \
-            authors, journal, mag_id, who_covidence_id, arxiv_id, pdf_json_files, pmc_json_files, url, s2_id \
-                in df.itertuples():
+        import pandas as pd
 
-            # Check there are no repeated keys
-            if cord_uid not in self.metadata_dict:
-                metadata = {'title': title, 'abstract': abstract, 'pdf_file': np.NaN, 'pmc_file': np.NaN}
+        if self.document_files is None:
+            self.list_document_files()
 
-                has_mapping_att = False
-                # Check there is a pmc file corresponding to that key
-                if not pd.isna(pmc_json_files) and os.path.isfile(self.data_folder_path + pmc_json_files):
-                    metadata['pmc_file'] = pmc_json_files
-                    has_mapping_att = True
+        layout = METADATA_SCHEMAS[schema]
+        columns = {'cord_uid', 'title', 'abstract'}
+        for spec in layout.values():
+            columns |= set(_get_path_columns(spec))
 
-                # Check there is a pdf file corresponding to that key
-                if not pd.isna(pdf_json_files) and os.path.isfile(self.data_folder_path + pdf_json_files):
-                    metadata['pdf_file'] = pdf_json_files
-                    has_mapping_att = True
+        df = pd.read_csv(self.metadata_file_path, low_memory=False, dtype=str, usecols=lambda c: c in columns)
 
-                # Check there was a pdf or pmc file corresponding to that key
-                if has_mapping_att:
-                    self.metadata_dict[cord_uid] = metadata
+        table = df[['cord_uid', 'title', 'abstract']].copy()
+        for key, spec in layout.items():
+            paths = _build_paths(df, spec)
+            table[key] = paths.where(paths.isin(self.document_files))
+
+        # Keep the first registry of every cord_uid among those with a pdf or pmc file
+        table = table[table['pmc_file'].notna() | table['pdf_file'].notna()]
+        table = table.drop_duplicates('cord_uid').set_index('cord_uid')
+        self.metadata_dict = MetadataTable(table)
+
+    def load_metadata_from_csv_round3(self):
+        """
+        Load the registries from the metadata file in csv format. This method should be executed before trying to
+        retrieve any document from the collection. It is designed for the metadata and dataset format of the third
+        round of the challenge.
+        :return: None
+        """
+
+        self.load_metadata_from_csv('round3')
 
     # DEPRECATED
     # def load_metadata_subsample_from_csv(self, samples_number):
@@ -93,45 +240,13 @@ class TrecCovidDatasetManager:
 
     def load_metadata_from_csv_round2(self):
         """
-        Load the registries from the metadata file in csv format to a dictionary. This method should be executed before
-        trying to retrieve any document from the collection. It is designed for the metadata and dataset format of the
+        Load the registries from the metadata file in csv format. This method should be executed before trying to
+        retrieve any document from the collection. It is designed for the metadata and dataset format of the
         second round of the challenge.
         :return: None
         """
 
-        df = pd.read_csv(self.metadata_file_path, low_memory=False, dtype=str)
-
-        for index, cord_uid, sha, source_x, title, doi, pmcid, pubmed_id, license, abstract, publish_time, \
-            authors, journal, microsoft_academic_paper_ID, who_covidence_id, arxiv_id, has_pdf_parse, \
-            has_pmc_xml_parse, full_text_file, url \
-                in df.itertuples():
-
-            # Check there are no repeated keys
-            if cord_uid not in self.metadata_dict:
-                # Check there is a pdf or pmc file corresponding to that key
-                has_mapping_att = False
-                metadata = {'title': title, 'abstract': abstract, 'pmc_file': np.NaN, 'pdf_file': np.NaN}
-
-                if has_pmc_xml_parse == 'True':
-                    # Build the path to the pmc file
-                    pmc_json_files = full_text_file + '/pmc_json/' + pmcid + '.xml.json'
-
-                    # Check there is a pmc file corresponding to that key
-                    if os.path.isfile(self.data_folder_path + pmc_json_files):
-                        metadata['pmc_file'] = pmc_json_files
-                        has_mapping_att = True
-
-                if has_pdf_parse == 'True':
-                    # Build the path to the pdf file
-                    pdf_json_files = full_text_file + '/pdf_json/' + sha + '.json'
-
-                    # Check there is a pdf file corresponding to that key
-                    if os.path.isfile(self.data_folder_path + pdf_json_files):
-                        metadata['pdf_file'] = pdf_json_files
-                        has_mapping_att = True
-
-                if has_mapping_att:
-                    self.metadata_dict[cord_uid] = metadata
+        self.load_metadata_from_csv('round2')
 
     # Saves metadata dict to disk
     def save_metadata_as_pickle(self):
@@ -160,19 +275,7 @@ class TrecCovidDatasetManager:
         :param doc_file_path: the file path of the json document
         :return: a dictionary containing the document attributes including title and text
         """
-        doc_json_file = io.open(file=self.data_folder_path + doc_file_path, mode='r', encoding='utf-8')
-        doc_json = json.load(doc_json_file)
-
-        paper_title = doc_json['metadata']['title']
-
-        paper_body_text = []
-
-        for t in doc_json['body_text']:
-            paper_body_text.append(t['text'])
-
-        doc_json_file.close()
-
-        return {'title': paper_title, 'text': paper_body_text}
+        return _parse_paper_json(self.data_folder_path + doc_file_path)
 
     # Given a cord_uid returns a document in dict format from its json file. The text att is a list of str
     def get_document_from_jsom(self, cord_uid):
@@ -188,17 +291,17 @@ class TrecCovidDatasetManager:
         metadata = self.metadata_dict[cord_uid]
 
         doc = {}
-        if not pd.isna(metadata['pmc_file']):
+        if not _is_missing(metadata['pmc_file']):
             # Check if the file exists in disk
             pmc_file = metadata['pmc_file']
-            if not os.path.isfile(self.data_folder_path + pmc_file):
+            if not self._file_exists(pmc_file):
                 raise Exception("Provided cord_uid does not match any document in our dataset")
 
             doc = self._load_doc_from_json_(pmc_file)
         else:
             # Check if the file exists in disk
             pdf_file = metadata['pdf_file']
-            if not os.path.isfile(self.data_folder_path + pdf_file):
+            if not self._file_exists(pdf_file):
                 raise Exception("Provided cord_uid does not match any document in our dataset")
 
             doc = self._load_doc_from_json_(pdf_file)
@@ -222,10 +325,10 @@ class TrecCovidDatasetManager:
         metadata = self.metadata_dict[cord_uid]
 
         pre_doc = {}
-        if not pd.isna(metadata['pmc_file']):
+        if not _is_missing(metadata['pmc_file']):
             # Check if the file exists in disk
             pmc_file = metadata['pmc_file']
-            if not os.path.isfile(self.data_folder_path + pmc_file):
+            if not self._file_exists(pmc_file):
                 raise Exception("Provided cord_uid does not match any document in our dataset")
 
             # load the file data
@@ -233,7 +336,7 @@ class TrecCovidDatasetManager:
         else:
             # Check if the file exists in disk
             pdf_file = metadata['pdf_file']
-            if not os.path.isfile(self.data_folder_path + pdf_file):
+            if not self._file_exists(pdf_file):
                 raise Exception("Provided cord_uid does not match any document in our dataset")
 
             # load the file data
@@ -244,28 +347,126 @@ class TrecCovidDatasetManager:
         return doc
 
     # Creates an in-memory dict with all the documents (can be memory-expensive)
-    def create_papers_dict(self):
+    def create_papers_dict(self, workers=None):
         """
         Reads all the documents and store them in a dictionary using the cord_uid's as keys. This method can be
         memory-expensive
+        :param workers: the number of processes parsing the json files, all the cpus by default
         :return: None
         """
 
+        for cord_uid, doc in self._iter_papers(workers):
+            self.paper_dict[cord_uid] = doc
+
+    # Resolves the file of every document, preferring the pmc parse over the pdf one
+    def _get_papers_files(self):
+        if self.document_files is None:
+            self.list_document_files()
+
+        papers_files = []
         for cord_uid, metadata in self.metadata_dict.items():
-            doc = {}
             pmc_file = metadata['pmc_file']
             pdf_file = metadata['pdf_file']
-            if not pd.isna(pmc_file):
-                if os.path.isfile(self.data_folder_path + pmc_file):
-                    doc = self._load_doc_from_json_(pmc_file)
-            else:
-                if os.path.isfile(self.data_folder_path + pdf_file):
-                    doc = self._load_doc_from_json_(pdf_file)
-
+            doc_file = pmc_file if not _is_missing(pmc_file) else pdf_file
             # Check if a document was found in the folders
-            if doc:
+            if self._file_exists(doc_file):
+                papers_files.append((cord_uid, doc_file))
+        return papers_files
+
+    # Parses every document with a pmc or pdf file in the metadata across a pool of processes, in metadata order
+    def _iter_papers(self, workers=None, papers_files=None, chunk_size=16):
+        papers_files = self._get_papers_files() if papers_files is None else papers_files
+        file_paths = [self.data_folder_path + doc_file for _, doc_file in papers_files]
+        workers = workers or os.cpu_count()
+
+        start = time.time()
+        if workers > 1:
+            # Only a bounded window of chunks is parsed ahead of the consumer, so a slow store writer does not pile
+            # the parsed corpus up in memory
+            chunks = iter([(papers_files[i: i + chunk_size], file_paths[i: i + chunk_size])
+                           for i in range(0, len(file_paths), chunk_size)])
+            pending = deque()
+            with ProcessPoolExecutor(workers) as executor:
+                for chunk_files, chunk_paths in itertools.islice(chunks, workers * 4):
+                    pending.append((chunk_files, executor.submit(_parse_papers_json, chunk_paths)))
+                while pending:
+                    chunk_files, future = pending.popleft()
+                    for next_files, next_paths in itertools.islice(chunks, 1):
+                        pending.append((next_files, executor.submit(_parse_papers_json, next_paths)))
+                    for (cord_uid, _), doc in zip(chunk_files, future.result()):
+                        doc['cord_uid'] = cord_uid
+                        yield cord_uid, doc
+        else:
+            for (cord_uid, _), file_path in zip(papers_files, file_paths):
+                doc = _parse_paper_json(file_path)
                 doc['cord_uid'] = cord_uid
-                self.paper_dict[cord_uid] = doc
+                yield cord_uid, doc
+
+        elapsed = time.time() - start
+        print("Parsed %s documents in %.1fs (%.0f docs/s)" % (len(papers_files), elapsed,
+                                                              len(papers_files) / max(elapsed, 1e-9)))
+
+    # Writes all the documents to the on-disk document store without holding them in memory
+    def create_docs_store(self, workers=None):
+        """
+        Reads all the documents and writes them to the compact document store in the docs_store folder. Unlike
+        create_papers_dict, documents are streamed to disk one at a time. The store is loaded afterwards.
+        :param workers: the number of processes parsing the json files, all the cpus by default
+        :return: None
+        """
+
+        papers_files = self._get_papers_files()
+        fingerprints = {cord_uid: self._get_fingerprint(doc_file) for cord_uid, doc_file in papers_files}
+        DocumentStore(self.data_folder_path + 'docs_store/').build(self._iter_papers(workers, papers_files),
+                                                                   fingerprints)
+        self.load_docs_store()
+
+    # Identifies the version of a document by its source file, modification time and size
+    def _get_fingerprint(self, doc_file_path):
+        stat = os.stat(self.data_folder_path + doc_file_path)
+        return [doc_file_path, stat.st_mtime_ns, stat.st_size]
+
+    # Brings the document store up to date with the current metadata, parsing only what changed
+    def update_docs_store(self, valid_docs_file_path=None, workers=None):
+        """
+        Updates the document store in the docs_store folder to the currently loaded metadata, e.g. after loading the
+        metadata of a new round. Documents are compared by cord_uid and by the path, modification time and size of
+        their source file: only added or changed documents are parsed and appended, and documents that are no longer
+        in the collection are tombstoned. If there is no store yet it is created from scratch. The store is loaded
+        afterwards.
+        :param valid_docs_file_path: optional docids file of the round, only those documents are kept in the store
+        :param workers: the number of processes parsing the json files, all the cpus by default
+        :return: a tuple with the list of added or changed cord_uid's and the list of removed ones
+        """
+
+        papers_files = self._get_papers_files()
+        if valid_docs_file_path is not None:
+            with open(valid_docs_file_path) as file_handle:
+                valid_docs = {line.strip() for line in file_handle}
+            papers_files = [(cord_uid, doc_file) for cord_uid, doc_file in papers_files if cord_uid in valid_docs]
+        fingerprints = {cord_uid: self._get_fingerprint(doc_file) for cord_uid, doc_file in papers_files}
+
+        # The first store only holds the documents of the round, as the later updates do
+        store = DocumentStore(self.data_folder_path + 'docs_store/')
+        if not os.path.isfile(store.index_file_path):
+            store.build(self._iter_papers(workers, papers_files), fingerprints)
+            self.load_docs_store()
+            return [cord_uid for cord_uid, _ in papers_files], []
+        store.load()
+
+        changed_files = [(cord_uid, doc_file) for cord_uid, doc_file in papers_files
+                         if cord_uid not in store or store.fingerprints.get(cord_uid) != fingerprints[cord_uid]]
+        removed = [cord_uid for cord_uid in store if cord_uid not in fingerprints]
+
+        print("Updating document store: %s added or changed, %s removed, %s unchanged"
+              % (len(changed_files), len(removed), len(papers_files) - len(changed_files)))
+        if changed_files:
+            store.append(self._iter_papers(workers, changed_files), fingerprints)
+        if removed:
+            store.remove(removed)
+
+        self.paper_dict = store
+        return [cord_uid for cord_uid, _ in changed_files], removed
 
     # Saves to disc the in-memory dict of documents
     def save_docs_dict_as_pickle(self):
@@ -288,6 +489,27 @@ class TrecCovidDatasetManager:
         with open(self.data_folder_path + 'docs_dict.pickle', 'rb') as file_handle:
             self.paper_dict = pickle.load(file_handle)
 
+    # Saves to disc the in-memory dict of documents as a compact document store
+    def save_docs_store(self):
+        """
+        Writes the documents dictionary to the compact document store in the docs_store folder
+        :return: None
+        """
+
+        DocumentStore(self.data_folder_path + 'docs_store/').build(self.paper_dict.items())
+
+    # Loads the previously saved document store
+    def load_docs_store(self):
+        """
+        Memory-maps the previously created document store. The documents are then served lazily from disk by the
+        get_document_from_dict* methods, only the pages that are read become resident.
+        :return: None
+        """
+
+        store = DocumentStore(self.data_folder_path + 'docs_store/')
+        store.load()
+        self.paper_dict = store
+
     # Given a cord_uid returns a document in dict format from the in-memory dict. The text att is a list of str
     def get_document_from_dict(self, cord_uid):
         """
@@ -316,10 +538,38 @@ class TrecCovidDatasetManager:
         if cord_uid not in self.paper_dict:
             raise Exception("Provided cord_uid does not match any document in our dataset")
 
+        # The store decodes the whole text in one slice instead of joining the paragraphs
+        if isinstance(self.paper_dict, DocumentStore):
+            return {'cord_uid': cord_uid, 'title': self.paper_dict.get_title(cord_uid),
+                    'text': self.paper_dict.get_text(cord_uid)}
+
         pre_doc = self.paper_dict[cord_uid]
         doc = {'cord_uid': cord_uid, 'title': pre_doc['title'], 'text': ''.join(pre_doc['text'])}
         return doc
 
+    # Given a cord_uid returns the title, the abstract and the paragraphs of the body, the passages of a document
+    def get_document_paragraphs(self, cord_uid, from_json=False):
+        """
+        Given a cord_uid returns the title and abstract from the metadata followed by the paragraphs of the document,
+        read from the internal documents dictionary. Missing titles or abstracts are left out.
+        :param cord_uid: The id of the document to retrieve
+        :param from_json: whether the paragraphs are read from the json file of the document instead
+        :return: a list of str
+        """
+
+        if not from_json and cord_uid not in self.paper_dict:
+            raise Exception("Provided cord_uid does not match any document in our dataset")
+
+        metadata = self.metadata_dict[cord_uid] if cord_uid in self.metadata_dict else {}
+        fields = [metadata.get('title'), metadata.get('abstract')]
+        if from_json:
+            paragraphs = self.get_document_from_jsom(cord_uid)['text']
+        elif isinstance(self.paper_dict, DocumentStore):
+            paragraphs = self.paper_dict.get_paragraphs(cord_uid)
+        else:
+            paragraphs = self.paper_dict[cord_uid]['text']
+        return [field for field in fields if isinstance(field, str) and field.strip()] + list(paragraphs)
+
     def get_valid_docs(self):
         return list(self.metadata_dict.keys())
 
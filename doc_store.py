@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import mmap
+from collections.abc import Mapping
+
+import numpy as np
+
+
+class DocumentStore(Mapping):
+    """
+    Compact on-disk store of the documents of the collection. The titles and paragraphs of every document are kept
+    as concatenated UTF-8 text in a single memory-mapped file, next to an array of (start, end) byte offsets per
+    paragraph and an array of (title start, title end, first paragraph, last paragraph) per document. Only the
+    cord_uid -> row index is held in memory, documents are decoded lazily on access.
+
+    The store is append-only: an updated document is appended as a new row that supersedes the old one, and a
+    removed document is tombstoned in the index, so updates between rounds only write the documents that changed.
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.text_file_path = os.path.join(folder_path, 'text.bin')
+        self.paragraphs_file_path = os.path.join(folder_path, 'paragraphs.i64')
+        self.docs_file_path = os.path.join(folder_path, 'docs.i64')
+        self.index_file_path = os.path.join(folder_path, 'index.json')
+        self.uids = []
+        self.uid_rows = {}
+        self.fingerprints = {}
+        self.deleted = set()
+        self.text = None
+        self.paragraphs = None
+        self.docs = None
+
+    def __getitem__(self, cord_uid):
+        return {'title': self.get_title(cord_uid), 'text': self.get_paragraphs(cord_uid), 'cord_uid': cord_uid}
+
+    def __contains__(self, cord_uid):
+        return cord_uid in self.uid_rows
+
+    def __iter__(self):
+        return iter(self.uid_rows)
+
+    def __len__(self):
+        return len(self.uid_rows)
+
+    # Memory maps can not be pickled, a copy sent to another process maps the files again
+    def __getstate__(self):
+        return {'folder_path': self.folder_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['folder_path'])
+        self.load()
+
+    # Writes the store from scratch
+    def build(self, papers, fingerprints=None):
+        """
+        Writes every document to the store, replacing any previous content
+        :param papers: an iterable of (cord_uid, doc) pairs where doc is a dict with a title and a list of paragraphs
+        :param fingerprints: optional dict of cord_uid -> fingerprint of the source file, used by incremental updates
+        :return: None
+        """
+
+        os.makedirs(self.folder_path, exist_ok=True)
+        self.uids = []
+        self.fingerprints = {}
+        self.deleted = set()
+        self._write(papers, fingerprints, 'wb')
+
+    # Appends new or updated documents, superseding any previous version
+    def append(self, papers, fingerprints=None):
+        """
+        Appends documents at the end of the store. A document already in the store is replaced by the new version.
+        :param papers: an iterable of (cord_uid, doc) pairs where doc is a dict with a title and a list of paragraphs
+        :param fingerprints: optional dict of cord_uid -> fingerprint of the source file
+        :return: None
+        """
+
+        self._write(papers, fingerprints, 'ab')
+
+    # Tombstones documents, their bytes stay in the files but they are no longer served
+    def remove(self, cord_uids):
+        """
+        Removes documents from the store index
+        :param cord_uids: the ids of the documents to remove
+        :return: None
+        """
+
+        for cord_uid in cord_uids:
+            self.fingerprints.pop(cord_uid, None)
+            self.deleted.add(cord_uid)
+        self._save_index()
+        self.load()
+
+    def _write(self, papers, fingerprints, mode):
+        fingerprints = fingerprints or {}
+        text_offset, paragraph_count = self._truncate() if mode == 'ab' else (0, 0)
+        uids = []
+
+        with open(self.text_file_path, mode) as text_file, open(self.paragraphs_file_path, mode) as paragraphs_file, \
+                open(self.docs_file_path, mode) as docs_file:
+            for cord_uid, doc in papers:
+                title = (doc['title'] or '').encode('utf-8')
+                text_file.write(title)
+                title_span = (text_offset, text_offset + len(title))
+                text_offset += len(title)
+
+                spans = []
+                for paragraph in doc['text']:
+                    paragraph = paragraph.encode('utf-8')
+                    text_file.write(paragraph)
+                    spans.append((text_offset, text_offset + len(paragraph)))
+                    text_offset += len(paragraph)
+
+                paragraphs_file.write(np.array(spans, dtype=np.int64).reshape(-1, 2).tobytes())
+                docs_file.write(np.array([title_span[0], title_span[1], paragraph_count, paragraph_count + len(spans)],
+                                         dtype=np.int64).tobytes())
+                paragraph_count += len(spans)
+                uids.append(cord_uid)
+
+        # The index only takes the new rows once they are all on disk, an interrupted write leaves it untouched
+        self.uids.extend(uids)
+        self.deleted.difference_update(uids)
+        self.fingerprints.update({cord_uid: fingerprints[cord_uid] for cord_uid in uids if cord_uid in fingerprints})
+        self._save_index()
+        self.load()
+
+    # Cuts the files back to the rows listed in the index, dropping whatever an interrupted write left after them, so
+    # the appended rows line up with their position in the index again
+    def _truncate(self):
+        self.load()
+        rows = len(self.uids)
+        text_size, paragraph_count = 0, 0
+        if rows:
+            _, title_end, first, last = (int(value) for value in self.docs[rows - 1])
+            text_size = int(self.paragraphs[last - 1][1]) if last > first else title_end
+            paragraph_count = last
+
+        self.text, self.paragraphs, self.docs = b'', None, None
+        for file_path, size in ((self.text_file_path, text_size), (self.paragraphs_file_path, paragraph_count * 16),
+                                (self.docs_file_path, rows * 32)):
+            if os.path.getsize(file_path) > size:
+                os.truncate(file_path, size)
+        return text_size, paragraph_count
+
+    def _save_index(self):
+        with open(self.index_file_path, 'w') as file_handle:
+            json.dump({'uids': self.uids, 'fingerprints': self.fingerprints, 'deleted': sorted(self.deleted)},
+                      file_handle)
+
+    def load(self):
+        """
+        Memory-maps the store files. Nothing but the cord_uid index is read until documents are requested.
+        :return: None
+        """
+
+        with open(self.index_file_path) as file_handle:
+            index = json.load(file_handle)
+        self.uids = index['uids']
+        self.fingerprints = index.get('fingerprints', {})
+        self.deleted = set(index.get('deleted', []))
+        # Later rows supersede earlier versions of the same document
+        self.uid_rows = {cord_uid: row for row, cord_uid in enumerate(self.uids) if cord_uid not in self.deleted}
+
+        self.text = b''
+        if os.path.getsize(self.text_file_path):
+            with open(self.text_file_path, 'rb') as file_handle:
+                self.text = mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.paragraphs = self._memmap(self.paragraphs_file_path, 2)
+        self.docs = self._memmap(self.docs_file_path, 4)
+
+    def _memmap(self, file_path, columns):
+        rows = os.path.getsize(file_path) // (8 * columns)
+        if not rows:
+            return np.zeros((0, columns), dtype=np.int64)
+        return np.memmap(file_path, dtype=np.int64, mode='r', shape=(rows, columns))
+
+    def _get_row(self, cord_uid):
+        if cord_uid not in self.uid_rows:
+            raise Exception("Provided cord_uid does not match any document in our dataset")
+        return self.docs[self.uid_rows[cord_uid]]
+
+    def get_title(self, cord_uid):
+        title_start, title_end, _, _ = self._get_row(cord_uid)
+        return self.text[title_start: title_end].decode('utf-8')
+
+    def get_paragraphs(self, cord_uid):
+        _, _, first, last = self._get_row(cord_uid)
+        return [self.text[start: end].decode('utf-8') for start, end in self.paragraphs[first: last]]
+
+    # The paragraphs of a document are contiguous, so its full text is a single slice of the text file
+    def get_text(self, cord_uid):
+        _, _, first, last = self._get_row(cord_uid)
+        if first == last:
+            return ''
+        return self.text[self.paragraphs[first][0]: self.paragraphs[last - 1][1]].decode('utf-8')
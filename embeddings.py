@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import numpy as np
+
+from utils import cosine_scores, segment_max
+
+
+class DocumentEmbeddingIndex():
+    """
+    Stores the chunk embeddings of every document of the collection in a single memory-mapped float32 matrix. Each
+    document owns a contiguous range of rows, one row per chunk, and the cord_uid -> rows mapping is kept in a small
+    json file next to the matrix.
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.embeddings_file_path = os.path.join(folder_path, 'embeddings.f32')
+        self.index_file_path = os.path.join(folder_path, 'index.json')
+        self.doc_ranges = {}
+        self.dim = 0
+        self.rows = 0
+        self.embeddings = None
+
+    def __contains__(self, cord_uid):
+        return cord_uid in self.doc_ranges
+
+    def __len__(self):
+        return len(self.doc_ranges)
+
+    # Encodes every document once and writes the embeddings to disk
+    def build(self, ranker, docs, valid_docs, block_size = 64):
+        """
+        Encodes the chunks of every valid document with the document-only pass of the ranker and stores them on disk.
+        Documents are encoded in blocks so their chunks share padded batches. Documents that can not be read or are
+        empty are skipped.
+        :param ranker: a model exposing encode_docs, i.e. BertSimilarity
+        :param docs: the TrecCovidDatasetManager holding the documents
+        :param valid_docs: the cord_uid's of the documents to encode
+        :param block_size: the number of documents encoded together
+        :return: None
+        """
+
+        os.makedirs(self.folder_path, exist_ok=True)
+        self.doc_ranges = {}
+        self.rows = 0
+        self._encode(ranker, docs, valid_docs, block_size, 'wb')
+
+    # Re-encodes only the documents that changed since the index was built
+    def update(self, ranker, docs, changed_docs, removed_docs, block_size = 64):
+        """
+        Appends the embeddings of added or changed documents at the end of the matrix, superseding their previous
+        rows, and drops removed documents from the index. The rows of replaced or removed documents stay in the file
+        unused.
+        :param ranker: a model exposing encode_docs, i.e. BertSimilarity
+        :param docs: the TrecCovidDatasetManager holding the documents
+        :param changed_docs: the cord_uid's of the added or changed documents
+        :param removed_docs: the cord_uid's of the removed documents
+        :param block_size: the number of documents encoded together
+        :return: None
+        """
+
+        # The new rows go after the ones on disk, even if this index was never loaded
+        if os.path.isfile(self.index_file_path):
+            self.load()
+        # Rows written by an interrupted update are not in the index, the new ones must start right after the indexed
+        self.embeddings = None
+        if os.path.isfile(self.embeddings_file_path) and \
+                os.path.getsize(self.embeddings_file_path) > self.rows * self.dim * 4:
+            os.truncate(self.embeddings_file_path, self.rows * self.dim * 4)
+        for cord_uid in list(changed_docs) + list(removed_docs):
+            self.doc_ranges.pop(cord_uid, None)
+        self._encode(ranker, docs, changed_docs, block_size, 'ab')
+
+    def _encode(self, ranker, docs, cord_uids, block_size, mode):
+        if getattr(ranker, 'passages', None) is not None and ranker.passages.needs_query:
+            raise Exception("The bm25 passage selection needs the query, the index encodes the documents without it")
+        # Paragraph-aware passages are built from the title, abstract and paragraphs instead of the whole text
+        paragraphs = getattr(ranker, 'passages', None) is not None and ranker.passages.paragraphs
+        with open(self.embeddings_file_path, mode) as file_handle:
+            block = []
+            for i, cord_uid in enumerate(cord_uids):
+                try:
+                    if paragraphs:
+                        doc = docs.get_document_paragraphs(cord_uid)
+                    else:
+                        doc = docs.get_document_from_dict_no_paragraph_list(cord_uid)['text']
+                except Exception as e:
+                    print("Skipping doc %s, %s: %s" % (i, cord_uid, e))
+                    continue
+                if not ''.join(doc).strip():
+                    print("Skipping doc %s, %s: empty document" % (i, cord_uid))
+                    continue
+
+                block.append((cord_uid, doc))
+                if len(block) == block_size:
+                    self._write_block(ranker, block, file_handle)
+                    block = []
+            if block:
+                self._write_block(ranker, block, file_handle)
+
+        self.save()
+        self.load()
+
+    def _write_block(self, ranker, block, file_handle):
+        doc_embeds = ranker.encode_docs([doc for _, doc in block], [cord_uid for cord_uid, _ in block])
+        for (cord_uid, _), chunk_embeds in zip(block, doc_embeds):
+            chunk_embeds = chunk_embeds.numpy().astype(np.float32)
+            file_handle.write(chunk_embeds.tobytes())
+            self.dim = chunk_embeds.shape[1]
+            self.doc_ranges[cord_uid] = (self.rows, self.rows + chunk_embeds.shape[0])
+            self.rows += chunk_embeds.shape[0]
+
+    def save(self):
+        """
+        Writes the cord_uid -> rows mapping to the index.json file
+        :return: None
+        """
+
+        with open(self.index_file_path, 'w') as file_handle:
+            json.dump({'dim': self.dim, 'rows': self.rows, 'docs': self.doc_ranges}, file_handle)
+
+    def load(self):
+        """
+        Loads the cord_uid -> rows mapping and memory-maps the embeddings matrix. Only the rows that are actually
+        scored are read from disk.
+        :return: None
+        """
+
+        with open(self.index_file_path) as file_handle:
+            index = json.load(file_handle)
+
+        self.dim = index['dim']
+        self.rows = index['rows']
+        self.doc_ranges = {cord_uid: tuple(rows) for cord_uid, rows in index['docs'].items()}
+        self.embeddings = None
+        if self.rows:
+            self.embeddings = np.memmap(self.embeddings_file_path, dtype=np.float32, mode='r',
+                                        shape=(self.rows, self.dim))
+
+    def get_chunk_embeddings(self, cord_uid):
+        """
+        Given a cord_uid returns its chunk embeddings
+        :param cord_uid: The id of the document
+        :return: a (chunks x dim) array
+        """
+
+        if cord_uid not in self.doc_ranges:
+            raise Exception("Provided cord_uid does not match any document in the embedding index")
+
+        start, end = self.doc_ranges[cord_uid]
+        return self.embeddings[start: end]
+
+    def get_doc_embeddings(self, cord_uids):
+        """
+        Mean-pools the chunk embeddings of each document, as BertSimilarity.rank does with its chunks
+        :param cord_uids: The ids of the documents
+        :return: a (documents x dim) array
+        """
+
+        rows = [np.arange(*self.doc_ranges[cord_uid]) for cord_uid in cord_uids]
+        lengths = np.array([len(r) for r in rows])
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        chunk_embeds = self.embeddings[np.concatenate(rows)]
+        return np.add.reduceat(chunk_embeds, starts, axis=0) / lengths[:, None]
+
+    def score(self, query_embeds, cord_uids, aggregation = 'mean'):
+        """
+        Computes the cosine similarity of every query against every given document with a single matrix product
+        :param query_embeds: a (queries x dim) array
+        :param cord_uids: The ids of the documents to score
+        :param aggregation: the passage aggregation of the ranker, 'mean' and 'firstp' score the mean-pooled chunks,
+        'maxp' scores every chunk and keeps the best one of each document
+        :return: a (queries x documents) array of similarities
+        """
+
+        import torch
+
+        query_embeds = torch.from_numpy(np.asarray(query_embeds, dtype=np.float32))
+        if aggregation == 'maxp':
+            rows = [np.arange(*self.doc_ranges[cord_uid]) for cord_uid in cord_uids]
+            owners = torch.from_numpy(np.repeat(np.arange(len(rows)), [len(r) for r in rows]))
+            chunk_embeds = torch.from_numpy(np.asarray(self.embeddings[np.concatenate(rows)], dtype=np.float32))
+            return segment_max(cosine_scores(query_embeds, chunk_embeds).T, owners, len(rows)).T.numpy()
+        if aggregation not in ('mean', 'firstp'):
+            raise Exception("Unknown passage aggregation %s" % aggregation)
+
+        doc_embeds = self.get_doc_embeddings(cord_uids)
+        return cosine_scores(query_embeds, torch.from_numpy(doc_embeds.astype(np.float32))).numpy()
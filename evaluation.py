@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In-process evaluation of TREC runs, several run files are scored in the same pass:
+#   python evaluation.py ./data/round3/qrels-rnd3.txt sim_output.txt bm25_output.txt --measures ndcg_cut_10 P_5 map
+#   python evaluation.py ./data/round3/qrels-rnd3.txt sim_output.txt --per-topic
+
+import re
+import argparse
+import numpy as np
+
+MEASURES = ('ndcg_cut_10', 'P_5', 'map', 'bpref')
+CUT_MEASURES = re.compile(r'^(ndcg_cut|P|recall)_(\d+)$')
+
+
+# The position of every element within its group, the groups being contiguous runs of equal values
+def _positions(groups):
+    if not len(groups):
+        return np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    return np.arange(len(groups)) - np.repeat(starts, np.diff(np.r_[starts, len(groups)]))
+
+# Cumulative sum restarted at every group, given the positions within the groups
+def _group_cumsum(values, positions):
+    total = np.cumsum(values)
+    return total - (total - values)[np.arange(len(values)) - positions]
+
+def _divide(a, b):
+    return np.divide(a, b, out=np.zeros(len(a)), where=b > 0)
+
+
+class Qrels():
+    """
+    Relevance judgments held as sorted arrays. Every judged (topic, document) pair is a single int64 key, so the
+    judgments of whole runs are looked up with a searchsorted instead of a dict access per line. Documents with a
+    relevance of at least relevance_level are relevant, the other judged ones non-relevant.
+    """
+
+    def __init__(self, relevance_level = 1):
+        self.relevance_level = relevance_level
+        self.qids = []
+        self.topic_index = {}
+        self.docids = np.zeros(0, dtype=str)
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.rels = np.zeros(0, dtype=np.int64)
+        self.n_rel = np.zeros(0)
+        self.n_nonrel = np.zeros(0)
+
+    def __len__(self):
+        return len(self.qids)
+
+    def read(self, filepath):
+        """
+        Streams a qrels file with 'qid iteration docid relevance' lines
+        :param filepath: the qrels file
+        :return: self
+        """
+
+        topics, docids, rels = [], [], []
+        with open(filepath) as file_handle:
+            for line in file_handle:
+                fields = line.split()
+                if not fields:
+                    continue
+                if len(fields) != 4:
+                    raise Exception("Malformed qrels line: %s" % line.strip())
+                topics.append(self.topic_index.setdefault(fields[0], len(self.topic_index)))
+                docids.append(fields[2])
+                rels.append(int(fields[3]))
+
+        self.qids = list(self.topic_index)
+        self.docids, docs = np.unique(np.array(docids, dtype=str), return_inverse=True)
+        keys = np.array(topics, dtype=np.int64) << 32 | docs.astype(np.int64)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.rels = np.array(rels, dtype=np.int64)[order]
+
+        topics = self.keys >> 32
+        self.n_rel = np.bincount(topics, self.rels >= self.relevance_level, minlength=len(self.qids))
+        self.n_nonrel = np.bincount(topics, (self.rels >= 0) & (self.rels < self.relevance_level),
+                                    minlength=len(self.qids))
+        return self
+
+    def lookup(self, topics, docids):
+        """
+        Judgments of (topic, document) pairs
+        :param topics: the topic indexes of the pairs
+        :param docids: the docids of the pairs, a str array
+        :return: the relevance of every pair, 0 when unjudged, and a mask of the judged pairs
+        """
+
+        if not len(self.keys):
+            return np.zeros(len(docids), dtype=np.int64), np.zeros(len(docids), dtype=bool)
+
+        docs = np.minimum(np.searchsorted(self.docids, docids), len(self.docids) - 1)
+        keys = topics.astype(np.int64) << 32 | docs
+        i = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        judged = (self.docids[docs] == docids) & (self.keys[i] == keys)
+        return np.where(judged, self.rels[i], 0), judged
+
+    # DCG of the best possible ranking of every topic, cut at k
+    def ideal_dcg(self, k):
+        topics = self.keys >> 32
+        order = np.lexsort((-self.rels, topics))
+        positions = _positions(topics[order])
+        gains = np.maximum(self.rels[order], 0) / np.log2(positions + 2) * (positions < k)
+        return np.bincount(topics[order], gains, minlength=len(self.qids))
+
+
+class Run():
+    """
+    A ranking of documents for some topics, as parallel arrays sorted by topic and then by descending score. Ties are
+    broken by descending docid, as trec_eval does, so the order of the lines of a run file does not matter.
+    """
+
+    def __init__(self, name = 'run'):
+        self.name = name
+        self.qids = []
+        self.topics = np.zeros(0, dtype=np.int64)
+        self.docids = np.zeros(0, dtype=str)
+        self.scores = np.zeros(0)
+
+    def __len__(self):
+        return len(self.docids)
+
+    @classmethod
+    def read(cls, filepath, name = None):
+        """
+        Streams a run file with 'qid Q0 docid rank score tag' lines
+        :param filepath: the run file
+        :param name: the name of the run, the file path if None
+        :return: the Run
+        """
+
+        run = cls(name or filepath)
+        topic_index, topics, docids, scores = {}, [], [], []
+        with open(filepath) as file_handle:
+            for line in file_handle:
+                fields = line.split()
+                if not fields:
+                    continue
+                if len(fields) != 6:
+                    raise Exception("Malformed run line: %s" % line.strip())
+                topics.append(topic_index.setdefault(fields[0], len(topic_index)))
+                docids.append(fields[2])
+                scores.append(float(fields[4]))
+        return run._set(list(topic_index), topics, docids, scores)
+
+    @classmethod
+    def from_result(cls, result, name = 'run'):
+        """
+        Builds a run from ranked results without writing them to a file
+        :param result: the (qid, docid, score, rank) tuples of RankerManager.get_top_k
+        :param name: the name of the run
+        :return: the Run
+        """
+
+        topic_index = {}
+        topics = [topic_index.setdefault(qid, len(topic_index)) for qid, _, _, _ in result]
+        return cls(name)._set(list(topic_index), topics, [docid for _, docid, _, _ in result],
+                              [float(score) for _, _, score, _ in result])
+
+    def _set(self, qids, topics, docids, scores):
+        self.qids = qids
+        topics = np.array(topics, dtype=np.int64)
+        docids = np.array(docids, dtype=str)
+        scores = np.array(scores, dtype=np.float64)
+        docid_order = np.unique(docids, return_inverse=True)[1]
+        order = np.lexsort((-docid_order, -scores, topics))
+        self.topics, self.docids, self.scores = topics[order], docids[order], scores[order]
+        return self
+
+
+def evaluate_runs(qrels, runs, measures = MEASURES, complete = False):
+    """
+    Scores runs against the judgments. The runs are concatenated and every (run, topic) pair is a group of the same
+    arrays, so each measure is a handful of vectorized operations whatever the number of runs and topics.
+    Measures: ndcg_cut_k, P_k, recall_k, map and bpref, as trec_eval computes them
+    :param qrels: a loaded Qrels
+    :param runs: a list of Run
+    :param measures: the names of the measures
+    :param complete: whether the judged topics missing from a run count as 0, as trec_eval -c does, instead of being
+    left out of its mean
+    :return: a dict with, for the name of every run, a dict with the mean of every measure under 'all' and the
+    measures of every topic under 'per_topic'
+    """
+
+    for measure in measures:
+        if measure not in ('map', 'bpref') and not CUT_MEASURES.match(measure):
+            raise Exception("Unknown measure %s" % measure)
+    if not len(qrels):
+        raise Exception("No judgments to evaluate against")
+
+    # Only the topics of the judgments are evaluated, the group of a line is run * topics + topic
+    n_topics = len(qrels)
+    groups, docids = [], []
+    for n, run in enumerate(runs):
+        topic_map = np.array([qrels.topic_index.get(qid, -1) for qid in run.qids] + [-1], dtype=np.int64)
+        topics = topic_map[run.topics]
+        judged_topic = topics >= 0
+        groups.append(n * n_topics + topics[judged_topic])
+        docids.append(run.docids[judged_topic])
+    groups = np.concatenate(groups) if groups else np.zeros(0, dtype=np.int64)
+    docids = np.concatenate(docids) if docids else np.zeros(0, dtype=str)
+    topics = groups % n_topics
+    n_groups = len(runs) * n_topics
+
+    def per_group(values):
+        return np.bincount(groups, values, minlength=n_groups).reshape(len(runs), n_topics)
+
+    positions = _positions(groups)
+    rels, judged = qrels.lookup(topics, docids)
+    relevant = judged & (rels >= qrels.relevance_level)
+    nonrelevant = judged & (rels >= 0) & ~relevant
+    n_rel = np.tile(qrels.n_rel, len(runs))
+
+    values = {}
+    for measure in measures:
+        if measure == 'map':
+            precisions = relevant * _group_cumsum(relevant, positions) / (positions + 1)
+            values[measure] = _divide(per_group(precisions).ravel(), n_rel)
+        elif measure == 'bpref':
+            # Relevant documents are penalized by the judged non-relevant ones ranked above them
+            nonrel_above = _group_cumsum(nonrelevant, positions) - nonrelevant
+            bound = np.minimum(qrels.n_rel, qrels.n_nonrel)[topics]
+            penalty = _divide(np.minimum(nonrel_above, qrels.n_rel[topics]), bound)
+            values[measure] = _divide(per_group(relevant * (1 - penalty)).ravel(), n_rel)
+        else:
+            name, k = CUT_MEASURES.match(measure).groups()
+            cut = positions < int(k)
+            if name == 'P':
+                values[measure] = per_group(relevant & cut).ravel() / int(k)
+            elif name == 'recall':
+                values[measure] = _divide(per_group(relevant & cut).ravel(), n_rel)
+            else:
+                gains = np.maximum(rels, 0) / np.log2(positions + 2) * cut
+                values[measure] = _divide(per_group(gains).ravel(), np.tile(qrels.ideal_dcg(int(k)), len(runs)))
+
+    evaluated = per_group(np.ones(len(groups))) > 0
+    if complete:
+        evaluated[:] = True
+
+    results = {}
+    for n, run in enumerate(runs):
+        topic_ids = np.flatnonzero(evaluated[n])
+        per_topic = {qrels.qids[t]: {measure: float(values[measure][n * n_topics + t]) for measure in measures}
+                     for t in topic_ids}
+        means = {measure: float(values[measure][n * n_topics + topic_ids].mean()) if len(topic_ids) else 0.
+                 for measure in measures}
+        results[run.name] = {'all': means, 'per_topic': per_topic}
+    return results
+
+def evaluate(qrels, run, measures = MEASURES, complete = False):
+    return evaluate_runs(qrels, [run], measures, complete)[run.name]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate TREC run files against qrels')
+    parser.add_argument('qrels')
+    parser.add_argument('runs', nargs='+')
+    parser.add_argument('--measures', nargs='+', default=list(MEASURES))
+    parser.add_argument('--relevance-level', type=int, default=1)
+    parser.add_argument('--per-topic', action='store_true', help='also print the measures of every topic')
+    parser.add_argument('--complete', action='store_true', help='judged topics missing from a run count as 0')
+    args = parser.parse_args()
+
+    qrels = Qrels(args.relevance_level).read(args.qrels)
+    results = evaluate_runs(qrels, [Run.read(run_file) for run_file in args.runs], args.measures, args.complete)
+    for name, result in results.items():
+        if args.per_topic:
+            for qid, topic_values in result['per_topic'].items():
+                for measure in args.measures:
+                    print("%s\t%s\t%s\t%.4f" % (name, measure, qid, topic_values[measure]))
+        for measure in args.measures:
+            print("%s\t%s\tall\t%.4f" % (name, measure, result['all'][measure]))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket is +Inf
+BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5., 10., 60.]
+
+
+class Histogram():
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.
+        self.min = float('inf')
+        self.max = 0.
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+        self.buckets[i] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else 0.,
+                'min': self.min if self.count else 0., 'max': self.max,
+                'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'], self.buckets))}
+
+
+class Metrics():
+    """
+    Timers, counters and error counts of the ranking pipeline. Stage latencies are aggregated into histograms, errors
+    are counted by exception type keeping the first message of each, and the progress of a run is printed
+    periodically with its rate and ETA instead of a line per (query, doc) pair. Metrics of worker processes can be
+    merged into the main ones, and everything can be exported as json or as a Prometheus text file.
+    """
+
+    def __init__(self, progress_every = 30.):
+        self.timers = {}
+        self.counters = {}
+        self.errors = {}
+        self.error_samples = {}
+        self.progress_every = progress_every
+        self.progress_total = 0
+        self.progress_done = 0
+        self.progress_start = None
+        self.last_progress = 0.
+        # Stages can be timed from several threads, i.e. the prefetch threads or the requests of the service
+        self.lock = threading.Lock()
+
+    # Locks cannot be pickled, the metrics of the worker processes are sent back without it
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.timers.setdefault(stage, Histogram()).observe(seconds)
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def error(self, e):
+        name = type(e).__name__
+        with self.lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            self.error_samples.setdefault(name, str(e))
+
+    def start_progress(self, total):
+        self.progress_total = total
+        self.progress_done = 0
+        self.progress_start = time.time()
+        self.last_progress = self.progress_start
+
+    def advance(self, n = 1):
+        self.progress_done += n
+        now = time.time()
+        if self.progress_start is not None and now - self.last_progress >= self.progress_every:
+            self.last_progress = now
+            self.print_progress()
+
+    def print_progress(self):
+        if self.progress_start is None:
+            return
+        elapsed = time.time() - self.progress_start
+        rate = self.progress_done / max(elapsed, 1e-9)
+        eta = (self.progress_total - self.progress_done) / rate if rate else float('inf')
+        print("Progress %s/%s (%.1f%%), %.1f/s, elapsed %.0fs, ETA %.0fs, errors %s"
+              % (self.progress_done, self.progress_total, 100. * self.progress_done / max(self.progress_total, 1),
+                 rate, elapsed, eta, sum(self.errors.values())))
+
+    # Adds up the metrics of another process, without touching the progress of this one
+    def merge(self, other):
+        for stage, histogram in other.timers.items():
+            self.timers.setdefault(stage, Histogram()).merge(histogram)
+        for name, n in other.counters.items():
+            self.count(name, n)
+        for name, n in other.errors.items():
+            self.errors[name] = self.errors.get(name, 0) + n
+            self.error_samples.setdefault(name, other.error_samples.get(name))
+        return self
+
+    def to_dict(self):
+        return {'timers': {stage: histogram.to_dict() for stage, histogram in self.timers.items()},
+                'counters': dict(self.counters), 'errors': dict(self.errors), 'error_samples': dict(self.error_samples),
+                'progress': {'done': self.progress_done, 'total': self.progress_total}}
+
+    def to_prometheus(self, prefix = 'trec_covid'):
+        lines = ['# TYPE %s_stage_seconds histogram' % prefix]
+        for stage, histogram in self.timers.items():
+            cumulative = 0
+            for bound, n in zip([str(b) for b in BUCKETS] + ['+Inf'], histogram.buckets):
+                cumulative += n
+                lines.append('%s_stage_seconds_bucket{stage="%s",le="%s"} %s' % (prefix, stage, bound, cumulative))
+            lines.append('%s_stage_seconds_sum{stage="%s"} %s' % (prefix, stage, histogram.sum))
+            lines.append('%s_stage_seconds_count{stage="%s"} %s' % (prefix, stage, histogram.count))
+        lines.append('# TYPE %s_events_total counter' % prefix)
+        for name, n in self.counters.items():
+            lines.append('%s_events_total{name="%s"} %s' % (prefix, name, n))
+        lines.append('# TYPE %s_errors_total counter' % prefix)
+        for name, n in self.errors.items():
+            lines.append('%s_errors_total{type="%s"} %s' % (prefix, name, n))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, output_file):
+        """
+        Writes the metrics to a file, in Prometheus text format if it ends in .prom and as json otherwise
+        :param output_file: the path of the file
+        :return: None
+        """
+
+        with open(output_file, 'w') as f:
+            if output_file.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
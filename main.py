@@ -1,14 +1,32 @@
 from data import TopicCollection, read_valid_docs
 from model import RankerManager, BertSimilarity
 from data_loader import TrecCovidDatasetManager
+from embeddings import DocumentEmbeddingIndex
+from ann import IVFIndex
+from bm25 import BM25Index
+from cache import TokenCache, QueryEmbeddingCache
+from passages import PassageStrategy
+from evaluation import Qrels, Run, evaluate_runs
 import random
 
 TOPICS = './data/round3/topics-rnd3.xml'
 VALID_DOCS = './data/round3/docids-rnd3.txt'
 METADATA = './data/round3/metadata.csv'
 DOCS = './data/round3/'
+EMBEDDINGS = './data/round3/embeddings/'
+ANN = './data/round3/ann/'
+BM25 = './data/round3/bm25/'
+TOKENS = './data/round3/tokens/'
+QUERIES = './data/round3/queries/'
+QRELS = './data/round3/qrels-rnd3.txt'
 
 ranking_model = BertSimilarity('./pretrained_models/scibert_scivocab_uncased')
+# ranking_model = BertSimilarity('./pretrained_models/scibert_scivocab_uncased', token_cache=TokenCache(TOKENS))
+# ranking_model = BertSimilarity('./pretrained_models/scibert_scivocab_uncased',
+#                                passages=PassageStrategy('paragraph', max_passages=8, selection='bm25', head=1,
+#                                                         aggregation='maxp'))
+# ranking_model = BertSimilarity('./pretrained_models/scibert_scivocab_uncased', mode='bi',
+#                                query_cache=QueryEmbeddingCache(QUERIES))
 queries = TopicCollection(TOPICS)
 
 # Reading the data set/////////////////////////////////////////////////////////////////////////////////////////
@@ -27,6 +45,14 @@ cov_dm.create_papers_dict()
 cov_dm.save_docs_dict_as_pickle()
 # cov_dm.load_docs_dict_from_pickle()
 
+# Or streaming the documents to the compact on-disk store and loading it lazily
+# cov_dm.create_docs_store()
+# cov_dm.load_docs_store()
+
+# Or updating the store of a previous round with only the documents that changed
+# changed_docs, removed_docs = cov_dm.update_docs_store(VALID_DOCS)
+# ranking_model.token_cache.remove(changed_docs + removed_docs)
+
 # Getting the valid docs/////////////////////////////////////////////////////////////////////////////////////
 valid_docs = cov_dm.get_valid_docs()
 valid_docs = random.sample(valid_docs, 1000)
@@ -35,4 +61,32 @@ valid_docs = random.sample(valid_docs, 1000)
 # Creating the Ranking///////////////////////////////////////////////////////////////////////////////////////
 
 manager = RankerManager(ranking_model, queries, cov_dm, valid_docs)
+# manager = RankerManager(ranking_model, queries, cov_dm, valid_docs, token_budget=16384)
+# manager = RankerManager(ranking_model, queries, cov_dm, valid_docs, qrel=Qrels().read(QRELS))
+# manager = RankerManager(ranking_model, queries, cov_dm, valid_docs, from_json=True, prefetch_workers=4)
 manager.manage_rank()
+
+# Re-ranking only the BM25 top candidates of every topic over the full collection /////////////////////////////
+# bm25 = BM25Index(BM25)
+# bm25.build(cov_dm, cov_dm.get_valid_docs())
+# bm25.load()
+# manager = RankerManager(ranking_model, queries, cov_dm, cov_dm.get_valid_docs(), first_stage=bm25, candidates=1000)
+# manager.manage_rank()
+
+# Encoding the corpus once and ranking against the embedding index ///////////////////////////////////////////
+# index = DocumentEmbeddingIndex(EMBEDDINGS)
+# index.build(ranking_model, cov_dm, cov_dm.get_valid_docs())
+# index.load()
+# index.update(ranking_model, cov_dm, changed_docs, removed_docs)
+# manager.manage_rank_from_index(index)
+
+# Ranking from an approximate first stage over the embedding index and an exact re-score of its shortlist ///////
+# ann = IVFIndex(ANN)
+# ann.build(index)
+# ann.load()
+# manager.evaluate_ann(index, ann)
+# manager.manage_rank_from_ann(index, ann)
+
+# Evaluating the runs of several configurations against the qrels in one pass ///////////////////////////////////
+# qrels = Qrels().read(QRELS)
+# evaluation = evaluate_runs(qrels, [Run.read('sim_output.txt'), Run.read('bm25_output.txt')], ['ndcg_cut_10', 'map'])
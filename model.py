@@ -1,117 +1,861 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
+import gc
+import math
+import time
+import inspect
+import tempfile
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
 import torch
-from transformers import BertTokenizer, BertModel
 
-from utils import split_doc
+from utils import TopKAccumulator, cosine_scores, paired_cosine_scores, segment_sum, segment_mean, segment_max
+from passages import PassageStrategy
+from instrumentation import Metrics
+from checkpoint import RankCheckpoint
+from scheduler import TokenBudgetScheduler
+from ann import recall_at_k
+from evaluation import MEASURES, Run, evaluate
+from prefetch import DocumentPrefetcher
+
+# Per-process state of the ranking workers, filled once by _init_rank_worker
+_worker_state = {}
+
+
+def _init_rank_worker(manager, num_threads):
+    torch.set_num_threads(num_threads)
+    if getattr(manager.ranker, 'token_cache', None) is not None:
+        manager.ranker.token_cache.read_only = True
+    if manager.checkpoint_log is not None:
+        manager.checkpoint_log = manager.checkpoint_log.for_worker(os.getpid())
+    _worker_state['manager'] = manager
+
+
+def _rank_shard(shard):
+    offset, docids, candidates = shard
+    manager = _worker_state['manager']
+    manager.set_metrics(Metrics())
+    return manager.pair_doc_query(docids, offset, candidates), manager.metrics
 
 
 class RankerManager():
-    def __init__(self, ranking_model, queries, docs, valid_docs, qrel = None, output = "sim_output.txt", run_tag = "sim_run"):
+    def __init__(self, ranking_model, queries, docs, valid_docs, qrel = None, output = "sim_output.txt", run_tag = "sim_run",
+                 batch_size = 16, k = 1000, workers = 1, threads_per_worker = 1, first_stage = None, candidates = 1000,
+                 metrics = None, metrics_output = None, checkpoint = None, token_budget = None, from_json = False,
+                 prefetch_workers = 0, prefetch_depth = 64):
         self.ranker = ranking_model
         self.topics = queries 
         self.docs = docs
         self.valid_docs = valid_docs        
+        # Qrels to evaluate every exported ranking against
         self.qrel = qrel
+        self.evaluation = None
         self.output = output
         self.run_tag = run_tag
+        self.batch_size = batch_size
+        self.k = k
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.first_stage = first_stage
+        self.candidates = candidates
+        # The first stage searches the whole valid_docs, its hits are mapped back to their position in it
+        self.first_stage_mask = first_stage.get_mask(valid_docs) if first_stage is not None else None
+        self.positions = {docid: i for i, docid in enumerate(valid_docs)} if first_stage is not None else None
+        self.metrics_output = metrics_output
+        self.checkpoint = checkpoint
+        self.checkpoint_log = None
+        # With a token budget the chunks are batched by length across docs instead of batch_size docs at a time
+        self.token_budget = token_budget
+        # Documents can be read from their json files instead of the papers dict or store, and with prefetch_workers
+        # they are read and tokenized in threads, at most prefetch_depth docs ahead of the model
+        self.from_json = from_json
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_depth = prefetch_depth
+        self.set_metrics(metrics or Metrics())
+
+    # The manager and the ranker report to the same metrics
+    def set_metrics(self, metrics):
+        self.metrics = metrics
+        if hasattr(self.ranker, 'metrics'):
+            self.ranker.metrics = metrics
         
     def manage_rank(self):
-        match_result = self.pair_doc_query()
-        ranked_result = self.get_top_k(match_result, 1000)
+        docs_per_topic = len(self.valid_docs) if self.first_stage is None else min(self.candidates, len(self.valid_docs))
+        self.metrics.start_progress(len(self.topics.topics) * docs_per_topic)
+
+        first_stage_candidates = self._search_candidates() if self.first_stage is not None else None
+
+        # Resuming from the checkpoint log skips the pairs it already holds, as long as they belong to this run
+        resumed = TopKAccumulator(self.k)
+        if self.checkpoint is not None:
+            self.checkpoint_log = RankCheckpoint(self.checkpoint)
+            if first_stage_candidates is None:
+                valid_docs = set(self.valid_docs)
+                pairs = {qid: valid_docs for qid in self.topics.topics}
+            else:
+                pairs = {qid: {docid for _, docid in hits} for qid, hits in first_stage_candidates.items()}
+            resumed = self.checkpoint_log.load(self.k, pairs)
+
+        try:
+            if self.workers > 1:
+                match_result = self.pair_doc_query_parallel(first_stage_candidates)
+            else:
+                match_result = self.pair_doc_query(first_stage_candidates=first_stage_candidates)
+        finally:
+            if self.checkpoint_log is not None:
+                self.checkpoint_log.flush()
+        match_result.merge(resumed)
+        ranked_result = self.get_top_k(match_result)
         self.export_result(ranked_result, self.output)
+        self.evaluate_result(ranked_result)
+
+        if getattr(self.ranker, 'token_cache', None) is not None:
+            self.ranker.token_cache.flush()
+
+        self.metrics.print_progress()
+        if self.metrics_output:
+            self.metrics.export(self.metrics_output)
+
+    def manage_rank_from_index(self, index):
+        match_result = self.pair_doc_query_from_index(index)
+        ranked_result = self.get_top_k(match_result)
+        self.export_result(ranked_result, self.output)
+        self.evaluate_result(ranked_result)
+
+    # Ranks with an approximate first stage over an IVFIndex and an exact re-score of its shortlist
+    def manage_rank_from_ann(self, index, ann, shortlist = None, n_probe = None):
+        match_result = self.pair_doc_query_from_ann(index, ann, shortlist, n_probe)
+        ranked_result = self.get_top_k(match_result)
+        self.export_result(ranked_result, self.output)
+        self.evaluate_result(ranked_result)
+
+    def evaluate_ann(self, index, ann, shortlist = None, n_probe = None):
+        """
+        Compares the ANN ranking with the exhaustive ranking over the embedding index
+        :param index: the DocumentEmbeddingIndex
+        :param ann: the IVFIndex built over it
+        :param shortlist: the number of documents retrieved per topic before the exact re-score, 2k by default
+        :param n_probe: the number of lists scanned per topic
+        :return: a dict with the mean recall@k, the recall of every topic and the time of both rankings
+        """
+
+        start = time.perf_counter()
+        exact = self.get_top_k(self.pair_doc_query_from_index(index))
+        exhaustive_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        approx = self.get_top_k(self.pair_doc_query_from_ann(index, ann, shortlist, n_probe))
+
+        report = recall_at_k(approx, exact)
+        report['k'] = self.k
+        report['exhaustive_seconds'] = exhaustive_seconds
+        report['ann_seconds'] = time.perf_counter() - start
+        print("ANN recall@%s %.4f, %.2fs instead of %.2fs"
+              % (self.k, report['recall'], report['ann_seconds'], report['exhaustive_seconds']))
+        return report
     
-    def pair_doc_query(self):
-        result = {}
+    # first_stage_candidates are the (position, docid) of the first-stage hits of every topic among valid_docs,
+    # searched here if not given. A shard of them may only hold some of the topics, the others have nothing to rank
+    def pair_doc_query(self, valid_docs = None, offset = 0, first_stage_candidates = None):
+        valid_docs = self.valid_docs if valid_docs is None else valid_docs
+        if getattr(self.ranker, 'mode', 'cross') == 'bi' and self.first_stage is None:
+            return self.pair_doc_query_bi(valid_docs, offset)
+
+        result = TopKAccumulator(self.k)
+        scheduler = self._get_scheduler() if getattr(self.ranker, 'mode', 'cross') == 'cross' else None
+        if self.first_stage is not None and first_stage_candidates is None:
+            first_stage_candidates = self._get_candidates(valid_docs)
         for qid in self.topics.topics:
             query = self.topics.get_topic(qid).text
-            for i,docid in enumerate(self.valid_docs):
-                print("Analyzing query %s, doc %s, %s " % (qid, i, docid))
+            if self.first_stage is None:
+                candidates = enumerate(valid_docs, start=offset)
+            else:
+                candidates = first_stage_candidates.get(qid, [])
+            batch = []
+            for i, docid, doc, error in self._fetch_docs(self._skip_done(candidates, [qid])):
                 try:
-                    doc = self.docs.get_document_from_dict_no_paragraph_list(docid)['text']
-                    #doc = self.docs.get_document_from_jsom_no_paragraph_list(docid)['text']
-                    score = self.rank(query, doc)
-                    result.setdefault(qid, {})[docid] = score
+                    if error is not None:
+                        raise error
+                    if scheduler is None:
+                        batch.append((i, docid, doc))
+                    else:
+                        finished = scheduler.submit((qid, i, docid), self.ranker.pair_inputs(query, doc, docid))
+                        self._push_pairs(finished, result)
                 except Exception as e:
-                    print(e)
+                    self.metrics.error(e)
+                    self.metrics.advance()
+
+                if len(batch) == self.batch_size:
+                    self._score_batch(qid, query, batch, result)
+                    batch = []
+            if batch:
+                self._score_batch(qid, query, batch, result)
+        if scheduler is not None:
+            self._push_pairs(scheduler.flush(), result)
+
+        if self.checkpoint_log is not None:
+            self.checkpoint_log.flush()
         return result    
+
+    # Drops the candidates whose pairs with all the given topics are already in the checkpoint log
+    def _skip_done(self, candidates, qids):
+        for i, docid in candidates:
+            if self.checkpoint_log is not None and all(self.checkpoint_log.is_done(qid, docid) for qid in qids):
+                self.metrics.count('skipped', len(qids))
+                self.metrics.advance(len(qids))
+                continue
+            yield i, docid
+
+    # Yields (position, docid, doc, error) for the candidates, fetched ahead by the prefetch threads if there are any
+    def _fetch_docs(self, candidates):
+        if self.prefetch_workers:
+            prefetcher = DocumentPrefetcher(lambda candidate: self._prefetch_doc(candidate[1]), self.prefetch_workers,
+                                            self.prefetch_depth, self.metrics)
+            for (i, docid), doc, error in prefetcher.iterate(candidates):
+                yield i, docid, doc, error
+            return
+
+        for i, docid in candidates:
+            try:
+                with self.metrics.timer('fetch'):
+                    doc = self._fetch_doc(docid)
+            except Exception as e:
+                yield i, docid, None, e
+                continue
+            yield i, docid, doc, None
+
+    # Runs in a prefetch thread, the doc is also tokenized there when the ranker supports it
+    def _prefetch_doc(self, docid):
+        with self.metrics.timer('fetch'):
+            doc = self._fetch_doc(docid)
+        if hasattr(self.ranker, 'pretokenize'):
+            return self.ranker.pretokenize(doc, docid)
+        return doc
+
+    def _fetch_doc(self, docid):
+        # Paragraph-aware passages need the title, abstract and paragraphs instead of the whole text
+        passages = getattr(self.ranker, 'passages', None)
+        if passages is not None and passages.paragraphs:
+            return self.docs.get_document_paragraphs(docid, from_json=self.from_json)
+
+        # The ranker can work from its token cache without the document text
+        token_cache = getattr(self.ranker, 'token_cache', None)
+        if token_cache is not None and docid in token_cache:
+            return None
+        if self.from_json:
+            return self.docs.get_document_from_jsom_no_paragraph_list(docid)['text']
+        return self.docs.get_document_from_dict_no_paragraph_list(docid)['text']
+
+    # Retrieves the BM25 top candidates of every topic among all valid_docs, once per ranking
+    def _search_candidates(self):
+        candidates = {}
+        for qid in self.topics.topics:
+            topic = self.topics.get_topic(qid)
+            hits = self.first_stage.search(topic.query + " " + topic.question, self.candidates, self.first_stage_mask)
+            candidates[qid] = [(self.positions[docid], docid) for docid, _ in hits]
+        return candidates
+
+    # Keeps the candidates of every topic that are in the given docs
+    def _get_candidates(self, valid_docs):
+        candidates = self._search_candidates()
+        if valid_docs is self.valid_docs:
+            return candidates
+        shard = set(valid_docs)
+        return {qid: [(i, docid) for i, docid in hits if docid in shard] for qid, hits in candidates.items()}
+
+    # Shards are whole multiples of batch_size so every process sees the same batches as the serial path
+    def _shard_size(self, n_items):
+        n_batches = math.ceil(n_items / self.batch_size)
+        return self.batch_size * max(1, math.ceil(n_batches / (self.workers * 4)))
+
+    # Shards valid_docs, or the first-stage candidates, across a pool of processes and merges the top-k of every
+    # shard as it arrives
+    def pair_doc_query_parallel(self, first_stage_candidates = None):
+        if self.first_stage is None:
+            shard_size = self._shard_size(len(self.valid_docs))
+            shards = [(i, self.valid_docs[i: i + shard_size], None) for i in range(0, len(self.valid_docs), shard_size)]
+        else:
+            # The first stage is searched once, here if not given. The serial path batches the candidates of every
+            # topic in their first-stage order, so the shards are slices of those lists rather than of valid_docs
+            if first_stage_candidates is None:
+                first_stage_candidates = self._search_candidates()
+            shard_size = self._shard_size(sum(len(hits) for hits in first_stage_candidates.values()))
+            shards = [(0, None, {qid: hits[i: i + shard_size]}) for qid, hits in first_stage_candidates.items()
+                      for i in range(0, len(hits), shard_size)]
+
+        # With fork the workers share the loaded model and documents copy-on-write instead of pickling them. Frozen
+        # objects are skipped by the garbage collector of the workers, which would otherwise write to their headers
+        # and copy every page holding them.
+        ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+        result = TopKAccumulator(self.k)
+        gc.freeze()
+        try:
+            executor = ProcessPoolExecutor(self.workers, mp_context=ctx, initializer=_init_rank_worker,
+                                           initargs=(self, self.threads_per_worker))
+            # With fork every worker is started by the first submit, while the objects are still frozen
+            futures = [executor.submit(_rank_shard, shard) for shard in shards]
+        finally:
+            gc.unfreeze()
+        try:
+            # A worker that dies, i.e. killed by the OOM killer, breaks the pool: the result of its shard raises
+            # BrokenProcessPool instead of never arriving, and the shards not started yet are cancelled
+            for future in as_completed(futures):
+                shard_result, shard_metrics = future.result()
+                result.merge(shard_result)
+                self.metrics.merge(shard_metrics)
+                self.metrics.advance(shard_metrics.progress_done)
+        finally:
+            executor.shutdown(cancel_futures=True)
+        return result
+
+    # Scores a batch of docs against a query with a single call to the ranker
+    def _score_batch(self, qid, query, batch, result):
+        try:
+            scores = self.rank_batch([(query, doc, docid) for _, docid, doc in batch])
+        except Exception as e:
+            self.metrics.error(e)
+            self.metrics.advance(len(batch))
+            return
+
+        self.metrics.count('pairs', len(batch))
+        for (position, docid, _), score in zip(batch, scores):
+            self._push(qid, docid, score, position, result)
+        self.metrics.advance(len(batch))
+
+    def _push(self, qid, docid, score, position, result):
+        if score is None:
+            self.metrics.count('unscored')
+        else:
+            result.push(qid, docid, score, position)
+            if self.checkpoint_log is not None:
+                self.checkpoint_log.append(qid, docid, position, score)
+
+    def _get_scheduler(self):
+        if not self.token_budget:
+            return None
+        return TokenBudgetScheduler(self.ranker._encode_batch, self.token_budget, metrics=self.metrics)
+
+    # Scores the pairs finished by the scheduler, the ones whose encoding failed were already counted as errors and
+    # are not counted as pairs
+    def _push_pairs(self, finished, result):
+        if not finished:
+            return
+        encoded = [(key, pooled) for key, pooled in finished if pooled is not None]
+        self.metrics.count('pairs', len(encoded))
+        scores = self.ranker.score_pooled_pairs([pooled for _, pooled in encoded]) if encoded else []
+        for ((qid, position, docid), _), score in zip(encoded, scores):
+            self._push(qid, docid, score, position, result)
+        self.metrics.advance(len(finished))
+
+    # Bi-encoder ranking goes over the docs once, every batch of docs is encoded once and scored against all the topics
+    def pair_doc_query_bi(self, valid_docs, offset = 0):
+        qids = list(self.topics.topics)
+        query_embeds = self.ranker.encode_queries([self.topics.get_topic(qid).text for qid in qids])
+        result = TopKAccumulator(self.k)
+        scheduler = self._get_scheduler()
+        batch = []
+        for i, docid, doc, error in self._fetch_docs(self._skip_done(enumerate(valid_docs, start=offset), qids)):
+            try:
+                if error is not None:
+                    raise error
+                if scheduler is None:
+                    batch.append((i, docid, doc))
+                else:
+                    finished = scheduler.submit((i, docid), self.ranker.doc_inputs(doc, docid))
+                    self._push_docs(qids, query_embeds, finished, result)
+            except Exception as e:
+                self.metrics.error(e)
+                self.metrics.advance(len(qids))
+
+            if len(batch) == self.batch_size:
+                self._score_docs_batch(qids, query_embeds, batch, result)
+                batch = []
+        if batch:
+            self._score_docs_batch(qids, query_embeds, batch, result)
+        if scheduler is not None:
+            self._push_docs(qids, query_embeds, scheduler.flush(), result)
+
+        if self.checkpoint_log is not None:
+            self.checkpoint_log.flush()
+        return result
+
+    def _score_docs_batch(self, qids, query_embeds, batch, result):
+        try:
+            docs, docids = [doc for _, _, doc in batch], [docid for _, docid, _ in batch]
+            scores = self.ranker.score_docs(query_embeds, docs, docids)
+        except Exception as e:
+            self.metrics.error(e)
+            self.metrics.advance(len(qids) * len(batch))
+            return
+
+        self.metrics.count('pairs', len(qids) * len(batch))
+        self._push_doc_scores(qids, [(position, docid) for position, docid, _ in batch], scores.tolist(), result)
+        self.metrics.advance(len(qids) * len(batch))
+
+    # Scores the docs finished by the scheduler against all the topics
+    def _push_docs(self, qids, query_embeds, finished, result):
+        if not finished:
+            return
+        encoded = [(key, pooled) for key, pooled in finished if pooled is not None]
+        self.metrics.count('pairs', len(qids) * len(encoded))
+        if encoded:
+            scores = self.ranker.score_pooled_docs(query_embeds, [pooled for _, pooled in encoded])
+            self._push_doc_scores(qids, [key for key, _ in encoded], scores.tolist(), result)
+        self.metrics.advance(len(qids) * len(finished))
+
+    def _push_doc_scores(self, qids, keys, scores, result):
+        for n, qid in enumerate(qids):
+            for (position, docid), score in zip(keys, scores[n]):
+                if self.checkpoint_log is not None and self.checkpoint_log.is_done(qid, docid):
+                    continue
+                self._push(qid, docid, None if math.isnan(score) else score, position, result)
+
+    # Scores every topic against the precomputed document embeddings, one matrix product per block of docs
+    # The index scores documents as the ranker aggregates their passages
+    def _aggregation(self):
+        passages = getattr(self.ranker, 'passages', None)
+        return passages.aggregation if passages is not None else 'mean'
+
+    def pair_doc_query_from_index(self, index, block_size = 4096):
+        qids = list(self.topics.topics)
+        query_embeds = self.ranker.encode_queries([self.topics.get_topic(qid).text for qid in qids]).numpy()
+        docids = [docid for docid in self.valid_docs if docid in index]
+
+        result = TopKAccumulator(self.k)
+        for start in range(0, len(docids), block_size):
+            block = docids[start: start + block_size]
+            scores = index.score(query_embeds, block, self._aggregation())
+            for i, qid in enumerate(qids):
+                # Only the block's own top-k can reach the final ranking
+                best = np.argpartition(-scores[i], min(self.k, len(block)) - 1)[:self.k]
+                for j in best:
+                    result.push(qid, block[j], float(scores[i, j]), start + int(j))
+        return result
+    
+    def pair_doc_query_from_ann(self, index, ann, shortlist = None, n_probe = None):
+        qids = list(self.topics.topics)
+        query_embeds = self.ranker.encode_queries([self.topics.get_topic(qid).text for qid in qids]).numpy()
+        positions = {docid: i for i, docid in enumerate(self.valid_docs)}
+
+        with self.metrics.timer('ann_search'):
+            hits = ann.search(query_embeds, shortlist or 2 * self.k, n_probe)
+
+        result = TopKAccumulator(self.k)
+        for qid, query_embed, qid_hits in zip(qids, query_embeds, hits):
+            docids = [docid for docid, _ in qid_hits if docid in positions and docid in index]
+            if not docids:
+                continue
+            with self.metrics.timer('rescore'):
+                scores = index.score(query_embed[None, :], docids, self._aggregation())[0]
+            for docid, score in zip(docids, scores.tolist()):
+                result.push(qid, docid, score, positions[docid])
+        return result
     
     def rank(self,query, doc):
         return self.ranker.rank(query, doc)
+
+    def rank_batch(self, pairs):
+        return self.ranker.rank_batch(pairs)
        
-    def get_top_k(self, result, k = 500):
-        final_result = []
-        for qid, scored_docs in result.items():
-            sorted_docs = {d:s for d,s in sorted(scored_docs.items(), key=lambda item: item[1], reverse=True)}
-            firstkpairs = {d: sorted_docs[d] for d in list(sorted_docs)[:k]}
-            tmp = [(qid, docid, score, i) for i, (docid, score) in enumerate(firstkpairs.items(), start=1)]
-            final_result += tmp
-        return final_result
+    def get_top_k(self, result):
+        return result.ranked(list(self.topics.topics))
     
     #topicid Q0 docid rank score run-tag
+    def format_result(self, result):
+        return ['%s Q0 %s %s %s %s\n' % (qid, docid, pos, score, self.run_tag) for (qid, docid, score, pos) in result]
+
     def export_result(self, result, output_file): 
         with open(output_file, mode='w+b') as f:
-            for (qid, docid, score, pos) in result:
-                line = bytes('%s Q0 %s %s %s %s\n' % (qid, docid, pos, score, self.run_tag), 'utf-8')
-                f.write(line )    
+            for line in self.format_result(result):
+                f.write(bytes(line, 'utf-8'))
+
+    # With qrels the ranking is evaluated in process instead of running trec_eval on the exported file
+    def evaluate_result(self, result, measures = MEASURES):
+        if self.qrel is None:
+            return None
+        self.evaluation = evaluate(self.qrel, Run.from_result(result, self.run_tag), measures)
+        print("Evaluation: %s" % ', '.join('%s %.4f' % item for item in self.evaluation['all'].items()))
+        return self.evaluation
+
+# Positional-argument wrapper returning only the last hidden state, as tracing and onnx export need
+class _LastHiddenState(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.model(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0]
+
+
+# The token ids of the paragraphs of a doc tokenized ahead of time, uncached if they still have to be stored in the
+# token cache
+class TokenizedDoc():
+    def __init__(self, paragraph_ids, uncached = False):
+        self.paragraph_ids = paragraph_ids
+        self.uncached = uncached
+
 
 class BertSimilarity():
-    def __init__(self, pretrained_model = 'bert-base-uncased'):
-        self.tokenizer = BertTokenizer.from_pretrained(pretrained_model)
+    # backend is one of 'fp32', 'int8' (dynamic quantization of the linear layers), 'torchscript' or 'onnx'
+    # (ONNX Runtime on CPU, onnx_path keeps the exported graph between runs). passages is the PassageStrategy that cuts
+    # long documents and aggregates their passage scores, equal chunks mean-pooled by default.
+    # mode 'cross' encodes every chunk as [CLS] query [SEP] doc [SEP], mode 'bi' encodes queries and documents apart
+    # so each query is encoded once, and once ever with a query_cache
+    def __init__(self, pretrained_model = 'bert-base-uncased', batch_size = 32, token_cache = None, backend = 'fp32',
+                 onnx_path = None, passages = None, mode = 'cross', query_cache = None):
+        # transformers takes seconds to import, it is only loaded once a model is created
+        from transformers import BertTokenizer, BertModel
+
+        # The Rust-backed tokenizer produces the same ids several times faster, it needs the tokenizers package
+        try:
+            from transformers import BertTokenizerFast
+        except ImportError:
+            BertTokenizerFast = None
+
+        if BertTokenizerFast is not None:
+            self.tokenizer = BertTokenizerFast.from_pretrained(pretrained_model)
+        else:
+            self.tokenizer = BertTokenizer.from_pretrained(pretrained_model)
+        self.pretrained_model = pretrained_model
         self.model = BertModel.from_pretrained(pretrained_model)
+        self.model.eval()
+        self.config = self.model.config
+        self.batch_size = batch_size
+        self.metrics = Metrics()
+        self.passages = passages or PassageStrategy()
+        if mode not in ('cross', 'bi'):
+            raise Exception("Unknown scoring mode %s" % mode)
+        if mode == 'bi' and self.passages.needs_query:
+            raise Exception("The bm25 passage selection needs the query, bi mode encodes the documents without it")
+        self.mode = mode
+
+        self.backend = backend
+        self.onnx_session = None
+        if backend == 'int8':
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif backend == 'torchscript':
+            self.model = torch.jit.freeze(torch.jit.trace(_LastHiddenState(self.model).eval(), self._example_inputs()))
+        elif backend == 'onnx':
+            self.onnx_session = self._load_onnx(onnx_path)
+            self.model = None
+        elif backend != 'fp32':
+            raise Exception("Unknown inference backend %s" % backend)
+
+        # Queries are tokenized once per run, documents once ever when a persistent cache is given
+        self.query_ids = {}
+        self.query_embeds = {}
+        self.query_cache = query_cache
+        self.token_cache = token_cache
+        if token_cache is not None:
+            token_cache.load()
+            token_cache.bind(pretrained_model)
+
+    def _example_inputs(self):
+        tokens_tensor = torch.full((2, 16), self.tokenizer.sep_token_id, dtype=torch.long)
+        return tokens_tensor, torch.ones_like(tokens_tensor), torch.zeros_like(tokens_tensor)
+
+    def _load_onnx(self, onnx_path):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise Exception("The onnx backend needs the onnxruntime package")
+
+        if onnx_path is None:
+            onnx_path = os.path.join(tempfile.mkdtemp(), 'model.onnx')
+        if not os.path.isfile(onnx_path):
+            axes = {0: 'batch', 1: 'sequence'}
+            kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+            torch.onnx.export(_LastHiddenState(self.model).eval(), self._example_inputs(), onnx_path,
+                              input_names=['input_ids', 'attention_mask', 'token_type_ids'],
+                              output_names=['last_hidden_state'],
+                              dynamic_axes={'input_ids': axes, 'attention_mask': axes, 'token_type_ids': axes,
+                                            'last_hidden_state': axes}, **kwargs)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        return onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+
+    # Runs the encoder with the selected backend and returns its last hidden state
+    def _forward(self, tokens_tensor, attention_mask, segments_tensor):
+        if self.onnx_session is not None:
+            outputs = self.onnx_session.run(['last_hidden_state'], {'input_ids': tokens_tensor.numpy(),
+                                                                      'attention_mask': attention_mask.numpy(),
+                                                                      'token_type_ids': segments_tensor.numpy()})
+            return torch.from_numpy(outputs[0])
+
+        with torch.no_grad():
+            if self.backend == 'torchscript':
+                return self.model(tokens_tensor, attention_mask, segments_tensor)
+            return self.model(tokens_tensor, attention_mask=attention_mask, token_type_ids=segments_tensor)[0]
+
+    # Compares the scores of this backend with the fp32 model on a sample of (query, doc) pairs
+    def check_accuracy(self, pairs, reference = None):
+        """
+        Ranks a sample of pairs with this model and with a reference, by default the same model, scoring mode and
+        passage strategy on the fp32 backend, so only the inference backend differs
+        :param pairs: a list of (query, doc) pairs
+        :param reference: optional BertSimilarity to compare with
+        :return: a dict with the max and mean absolute score difference and the Spearman correlation of the scores
+        """
+
+        reference = reference or BertSimilarity(self.pretrained_model, self.batch_size, passages=self.passages,
+                                                mode=self.mode)
+        scores = np.array(self.rank_batch(pairs), dtype=np.float64)
+        reference_scores = np.array(reference.rank_batch(pairs), dtype=np.float64)
+
+        diff = np.abs(scores - reference_scores)
+        ranks = np.argsort(np.argsort(scores))
+        reference_ranks = np.argsort(np.argsort(reference_scores))
+        spearman = np.corrcoef(ranks, reference_ranks)[0, 1] if len(pairs) > 1 else 1.
+        return {'backend': self.backend, 'pairs': len(pairs), 'max_abs_diff': float(diff.max()),
+                'mean_abs_diff': float(diff.mean()), 'spearman': float(spearman)}
+
+    def _tokenize(self, text):
+        with self.metrics.timer('tokenization'):
+            return np.asarray(self.tokenizer.encode(text, add_special_tokens=False, verbose=False), dtype=np.int64)
+
+    def tokenize_query(self, query):
+        if query not in self.query_ids:
+            self.query_ids[query] = self._tokenize(query)
+        return self.query_ids[query]
+
+    def tokenize_doc(self, doc, docid = None):
+        if self.token_cache is not None and docid is not None:
+            doc_ids = self.token_cache.get(docid)
+            if doc_ids is None:
+                doc_ids = self._tokenize(doc)
+                self.token_cache.put(docid, doc_ids)
+            return doc_ids
+        return self._tokenize(doc)
    
-    def _split_doc(self, query, doc):    
-        tok_query = self.tokenizer.tokenize(query)
-        tok_doc = self.tokenizer.tokenize(doc)
+    # Tokenizes a doc ahead of its batch, i.e. in a prefetch thread. The token cache is not written from there, the
+    # new ids are stored when the doc is used
+    def pretokenize(self, doc, docid = None):
+        if doc is None:
+            return None
+        if isinstance(doc, list):
+            return TokenizedDoc([self._tokenize(paragraph) for paragraph in doc])
+        return TokenizedDoc([self._tokenize(doc)], uncached=self.token_cache is not None and docid is not None)
+
+    # A doc is either its whole text or the list of its paragraphs, which are tokenized separately and not cached
+    def _tokenize_paragraphs(self, doc, docid = None):
+        if isinstance(doc, TokenizedDoc):
+            if doc.uncached:
+                self.token_cache.put(docid, doc.paragraph_ids[0])
+            return doc.paragraph_ids
+        if isinstance(doc, list):
+            return [self._tokenize(paragraph) for paragraph in doc]
+        return [self.tokenize_doc(doc, docid)]
+
+    def _split_doc(self, query, doc, docid = None):    
+        query_ids = self.tokenize_query(query)
+        paragraph_ids = self._tokenize_paragraphs(doc, docid)
         
-        query_len = len(tok_query)
+        query_len = len(query_ids)
         adit_len = 3
-        maxlen = self.model.config.max_position_embeddings
+        maxlen = self.config.max_position_embeddings
         max_doc_len = maxlen - query_len - adit_len
         
-        doc_chunks, _ = split_doc(tok_doc, max_doc_len)
-        return tok_query, doc_chunks        
+        with self.metrics.timer('chunking'):
+            doc_chunks = self.passages.select(self.passages.split(paragraph_ids, max_doc_len), query_ids)
+        return query_ids, doc_chunks        
     
-    def _format_input(self, query_tok, doc_tok):
-        tokenized_text = ["[CLS] "] + query_tok + [" [SEP]"] + doc_tok + [" [SEP]"]
-
-        indexed_tokens = self.tokenizer.convert_tokens_to_ids(tokenized_text)
-        segments_ids = [1] * (len(query_tok) + 2) + [0] * (len(doc_tok) + 1)
-
-        tokens_tensor = torch.tensor([indexed_tokens])
-        segments_tensors = torch.tensor([segments_ids])
-        sep_idx = len(query_tok)
-        return tokens_tensor, segments_tensors, sep_idx        
-      
-    def _embed(self, query_tok, doc_tok):
-        tokens_tensor, segments_tensors, sep_index = self._format_input(query_tok, doc_tok)
-        
-        self.model.eval()
-        with torch.no_grad():
-            last_hidden_state,_,_ = self.model(tokens_tensor, segments_tensors)
-            
-        last_hidden_state = last_hidden_state.squeeze(dim = 0)
-        query_embed = last_hidden_state[1: sep_index]
-        doc_embed = last_hidden_state[sep_index + 1:]
-
-        query_embed = torch.sum(query_embed, dim = 0)
-        doc_embed = torch.sum(doc_embed, dim=0)        
-        return query_embed, doc_embed
-    
-    def _calculate_similarity(self, query_embed, doc_embed):
-        from scipy.spatial.distance import cosine
-        return 1 - cosine(query_embed, doc_embed)
-            
+    # Builds [CLS] query [SEP] doc [SEP] and the spans of the query and doc tokens in it
+    def _format_input(self, query_ids, doc_ids):
+        cls, sep = [self.tokenizer.cls_token_id], [self.tokenizer.sep_token_id]
+        indexed_tokens = np.concatenate([cls, query_ids, sep, doc_ids, sep]).astype(np.int64)
+        segments_ids = np.concatenate([np.ones(len(query_ids) + 2), np.zeros(len(doc_ids) + 1)]).astype(np.int64)
+
+        sep_idx = len(query_ids) + 1
+        spans = [(1, sep_idx), (sep_idx + 1, len(indexed_tokens) - 1)]
+        return indexed_tokens, segments_ids, spans
+
+    # Runs one forward pass over a padded batch and sum-pools the requested spans of every sequence
+    def _encode_batch(self, inputs):
+        maxlen = max(len(indexed_tokens) for indexed_tokens, _, _ in inputs)
+        tokens_tensor = torch.zeros((len(inputs), maxlen), dtype=torch.long)
+        segments_tensor = torch.zeros((len(inputs), maxlen), dtype=torch.long)
+        attention_mask = torch.zeros((len(inputs), maxlen), dtype=torch.long)
+        for i, (indexed_tokens, segments_ids, _) in enumerate(inputs):
+            tokens_tensor[i, :len(indexed_tokens)] = torch.from_numpy(indexed_tokens)
+            segments_tensor[i, :len(segments_ids)] = torch.from_numpy(segments_ids)
+            attention_mask[i, :len(indexed_tokens)] = 1
+
+        self.metrics.count('batches')
+        self.metrics.count('chunks', len(inputs))
+        self.metrics.count('batch_tokens', tokens_tensor.numel())
+        self.metrics.count('tokens', int(attention_mask.sum()))
+        with self.metrics.timer('forward'):
+            last_hidden_state = self._forward(tokens_tensor, attention_mask, segments_tensor)
+
+        # Every token of a span is labelled with the span number, so all the spans of the batch are pooled at once
+        with self.metrics.timer('pooling'):
+            span_ids = torch.full((len(inputs), maxlen), -1, dtype=torch.long)
+            n_spans = 0
+            for i, (_, _, spans) in enumerate(inputs):
+                for start, end in spans:
+                    span_ids[i, start: end] = n_spans
+                    n_spans += 1
+            in_span = span_ids >= 0
+            pooled = segment_sum(last_hidden_state[in_span], span_ids[in_span], n_spans)
+            return list(torch.split(pooled, [len(spans) for _, _, spans in inputs]))
+
+    # Encodes many sequences in length-sorted batches and returns the pooled spans in the input order
+    def _encode_sequences(self, inputs):
+        order = sorted(range(len(inputs)), key=lambda i: len(inputs[i][0]))
+        pooled = [None] * len(inputs)
+        for start in range(0, len(order), self.batch_size):
+            batch_idx = order[start: start + self.batch_size]
+            for i, embeds in zip(batch_idx, self._encode_batch([inputs[i] for i in batch_idx])):
+                pooled[i] = embeds
+        return pooled
+
+    # Cosine similarity of every query against every doc, (queries x dim), (docs x dim) -> (queries x docs)
+    def score_matrix(self, query_embeds, doc_embeds):
+        with self.metrics.timer('similarity'):
+            return cosine_scores(query_embeds, doc_embeds)
+
     def rank(self, query, doc):        
-        query_tok, splitted_doc_tok = self._split_doc(query, doc)
-             
-        queries, docs = [], []
-        for doc in splitted_doc_tok:
-            q, d = self._embed(query_tok, doc)
-            queries.append(q.unsqueeze(dim=0))
-            docs.append(d.unsqueeze(dim=0))            
-       
-        query_embed = torch.cat(queries, dim= 0).mean(dim=0)
-        doc_embed = torch.cat(docs, dim= 0).mean(dim=0)
-        return self._calculate_similarity(query_embed, doc_embed)
\ No newline at end of file
+        return self.rank_batch([(query, doc)])[0]
+
+    # Ranks many (query, doc) or (query, doc, docid) pairs at once, batching the chunks of all the pairs together.
+    # With a docid the doc tokens come from the token cache, and doc may be None if it is cached.
+    def rank_batch(self, pairs):
+        if self.mode == 'bi':
+            return self._rank_batch_bi(pairs)
+        return self.score_pooled_pairs(self._encode_groups([self.pair_inputs(*pair) for pair in pairs]))
+
+    # The formatted [CLS] query [SEP] chunk [SEP] inputs of a pair, what the cross mode encodes for it
+    def pair_inputs(self, query, doc, docid = None):
+        query_ids, splitted_doc_ids = self._split_doc(query, doc, docid)
+        return [self._format_input(query_ids, doc_ids) for doc_ids in splitted_doc_ids]
+
+    # Encodes the inputs of many pairs or docs together and regroups the pooled spans by pair or doc
+    def _encode_groups(self, groups):
+        pooled = iter(self._encode_sequences([inputs for group in groups for inputs in group]))
+        return [[next(pooled) for _ in group] for group in groups]
+
+    def score_pooled_pairs(self, pooled_pairs):
+        """
+        Aggregates the pooled chunks of every pair into its score with the passage strategy
+        :param pooled_pairs: for every pair the list of its (2 x dim) query and doc span embeddings, one per chunk
+        :return: the list of scores, None for the pairs without chunks
+        """
+
+        owners = [n for n, pooled in enumerate(pooled_pairs) for _ in pooled]
+        if not owners:
+            return [None] * len(pooled_pairs)
+
+        # (chunks x 2 x dim) query and doc span embeddings
+        chunk_embeds = torch.stack([embeds for pooled in pooled_pairs for embeds in pooled], dim=0)
+        owners = torch.tensor(owners, dtype=torch.long)
+        with self.metrics.timer('similarity'):
+            if self.passages.aggregation == 'maxp':
+                chunk_scores = paired_cosine_scores(chunk_embeds[:, 0], chunk_embeds[:, 1])
+                scores = segment_max(chunk_scores, owners, len(pooled_pairs)).tolist()
+            else:
+                # Mean-pooled into (pairs x 2 x dim), with firstp there is a single passage per pair
+                pair_embeds = segment_mean(chunk_embeds, owners, len(pooled_pairs))
+                scores = paired_cosine_scores(pair_embeds[:, 0], pair_embeds[:, 1]).tolist()
+
+        return [score if len(pooled) else None for score, pooled in zip(scores, pooled_pairs)]
+
+    # Builds [CLS] tokens [SEP] for the document-only and query-only encodings
+    def _format_segment(self, token_ids):
+        indexed_tokens = np.concatenate([[self.tokenizer.cls_token_id], token_ids, [self.tokenizer.sep_token_id]])
+        indexed_tokens = indexed_tokens.astype(np.int64)
+        return indexed_tokens, np.zeros(len(indexed_tokens), dtype=np.int64), [(1, len(indexed_tokens) - 1)]
+
+    # Query-only encoding, kept for the whole run and in the query cache across runs
+    def encode_query(self, query):
+        return self.encode_queries([query])[0]
+
+    # Encodes the queries that are not cached yet in one go, returns a (queries x dim) tensor
+    def encode_queries(self, queries):
+        missing = [query for query in dict.fromkeys(queries) if query not in self.query_embeds]
+        if self.query_cache is not None:
+            for query in missing:
+                cached = self.query_cache.get(self._query_key(query))
+                if cached is not None:
+                    self.query_embeds[query] = torch.from_numpy(cached)
+            missing = [query for query in missing if query not in self.query_embeds]
+
+        maxlen = self.config.max_position_embeddings - 2
+        inputs = [self._format_segment(self.tokenize_query(query)[:maxlen]) for query in missing]
+        for query, pooled in zip(missing, self._encode_sequences(inputs)):
+            self.query_embeds[query] = pooled[0]
+            if self.query_cache is not None:
+                self.query_cache.put(self._query_key(query), pooled[0].numpy())
+        return torch.stack([self.query_embeds[query] for query in queries], dim=0)
+
+    def _query_key(self, query):
+        return self.query_cache.key(self.pretrained_model, self.backend, query)
+
+    # Document-only encoding, one embedding per chunk, independent of any query
+    def encode_doc(self, doc):
+        return self.encode_docs([doc])[0]
+
+    def encode_docs(self, docs, docids = None):
+        docids = [None] * len(docs) if docids is None else docids
+        pooled_docs = self._encode_groups([self.doc_inputs(doc, docid) for doc, docid in zip(docs, docids)])
+        if not all(pooled_docs):
+            raise Exception("Cannot encode an empty document")
+        return [torch.stack(pooled, dim=0)[:, 0] for pooled in pooled_docs]
+
+    # The formatted [CLS] chunk [SEP] inputs of a doc, none for an empty doc
+    def doc_inputs(self, doc, docid = None):
+        maxlen = self.config.max_position_embeddings - 2
+        paragraph_ids = self._tokenize_paragraphs(doc, docid)
+        with self.metrics.timer('chunking'):
+            doc_chunks = self.passages.select(self.passages.split(paragraph_ids, maxlen))
+        return [self._format_segment(chunk) for chunk in doc_chunks]
+
+    def score_docs(self, query_embeds, docs, docids = None):
+        """
+        Bi-encoder scores of a block of queries against a block of documents, the documents are encoded once for all
+        the queries and their passages aggregated with the passage strategy
+        :param query_embeds: a (queries x dim) tensor, i.e. stacked encode_query outputs
+        :param docs: the documents, their text or list of paragraphs, may be None if their docid is in the token cache
+        :param docids: optional cord_uid's of the documents
+        :return: a (queries x documents) tensor of similarities, NaN for the empty documents
+        """
+
+        docids = [None] * len(docs) if docids is None else docids
+        pooled_docs = self._encode_groups([self.doc_inputs(doc, docid) for doc, docid in zip(docs, docids)])
+        return self.score_pooled_docs(query_embeds, pooled_docs)
+
+    def score_pooled_docs(self, query_embeds, pooled_docs):
+        """
+        Aggregates the pooled chunks of every doc and scores them against every query
+        :param query_embeds: a (queries x dim) tensor
+        :param pooled_docs: for every doc the list of its (1 x dim) chunk embeddings
+        :return: a (queries x documents) tensor of similarities, NaN for the docs without chunks
+        """
+
+        owners = torch.tensor([n for n, pooled in enumerate(pooled_docs) for _ in pooled], dtype=torch.long)
+        if not len(owners):
+            return torch.full((len(query_embeds), len(pooled_docs)), float('nan'))
+
+        chunk_embeds = torch.stack([embeds[0] for pooled in pooled_docs for embeds in pooled], dim=0)
+        with self.metrics.timer('similarity'):
+            if self.passages.aggregation == 'maxp':
+                scores = segment_max(cosine_scores(query_embeds, chunk_embeds).T, owners, len(pooled_docs)).T
+            else:
+                scores = cosine_scores(query_embeds, segment_mean(chunk_embeds, owners, len(pooled_docs)))
+
+        n_chunks = torch.bincount(owners, minlength=len(pooled_docs))
+        return scores.masked_fill(n_chunks[None, :] == 0, float('nan'))
+
+    # Bi-encoder rank_batch, the pairs of a batch usually share their query
+    def _rank_batch_bi(self, pairs):
+        queries = list(dict.fromkeys(pair[0] for pair in pairs))
+        query_embeds = self.encode_queries(queries)
+        docids = [pair[2] if len(pair) > 2 else None for pair in pairs]
+        scores = self.score_docs(query_embeds, [pair[1] for pair in pairs], docids)
+
+        rows = [queries.index(pair[0]) for pair in pairs]
+        scores = scores[rows, torch.arange(len(pairs))].tolist()
+        return [None if math.isnan(score) else score for score in scores]
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import numpy as np
+
+from utils import split_doc
+
+MODES = ('split', 'sliding', 'paragraph')
+SELECTIONS = ('first', 'bm25')
+AGGREGATIONS = ('mean', 'maxp', 'firstp')
+
+
+class PassageStrategy():
+    """
+    How the token ids of a long document are cut into passages that fit the model, how many of them are scored and
+    how the passage scores are combined into the document score.
+    mode: 'split' cuts the document in equal non-overlapping chunks, 'sliding' in windows of the maximum length
+    every stride tokens, and 'paragraph' packs consecutive paragraphs into passages, splitting only the paragraphs
+    longer than a passage.
+    max_passages: the number of passages kept per document, all of them if None. The first head passages are always
+    kept (i.e. the title and abstract in paragraph mode), the rest are the first ones or the ones that best match the
+    query according to BM25 when selection is 'bm25'. The BM25 selection needs the query, so it can not be used when
+    documents are encoded on their own, i.e. in bi mode or in a DocumentEmbeddingIndex.
+    aggregation: 'mean' mean-pools the passage embeddings before the similarity, 'maxp' takes the best passage score
+    and 'firstp' only scores the first passage.
+    """
+
+    def __init__(self, mode = 'split', stride = None, max_passages = None, selection = 'first', head = 0,
+                 aggregation = 'mean', k1 = 0.9, b = 0.4):
+        if mode not in MODES:
+            raise Exception("Unknown passage mode %s" % mode)
+        if selection not in SELECTIONS:
+            raise Exception("Unknown passage selection %s" % selection)
+        if aggregation not in AGGREGATIONS:
+            raise Exception("Unknown passage aggregation %s" % aggregation)
+
+        self.mode = mode
+        self.stride = stride
+        self.max_passages = 1 if aggregation == 'firstp' else max_passages
+        self.selection = selection
+        self.head = head
+        self.aggregation = aggregation
+        self.k1 = k1
+        self.b = b
+
+    # Whether the kept passages depend on the query, documents can then only be cut when paired with it
+    @property
+    def needs_query(self):
+        return self.selection == 'bm25' and self.max_passages is not None and self.max_passages > self.head
+
+    # Paragraph mode needs the paragraph list of the documents instead of their whole text
+    @property
+    def paragraphs(self):
+        return self.mode == 'paragraph'
+
+    def split(self, paragraph_ids, maxlen):
+        """
+        Cuts a document into passages
+        :param paragraph_ids: the token ids of every paragraph of the document, a single array for the whole text
+        outside paragraph mode
+        :param maxlen: the maximum number of tokens of a passage
+        :return: a list of arrays of token ids
+        """
+
+        paragraph_ids = [ids for ids in paragraph_ids if len(ids)]
+        if not paragraph_ids:
+            return []
+        if self.mode == 'paragraph':
+            return self._pack_paragraphs(paragraph_ids, maxlen)
+
+        doc_ids = np.concatenate(paragraph_ids) if len(paragraph_ids) > 1 else paragraph_ids[0]
+        if self.mode == 'sliding':
+            return self._sliding_windows(doc_ids, maxlen)
+        return split_doc(doc_ids, maxlen)[0]
+
+    def _sliding_windows(self, doc_ids, maxlen):
+        stride = self.stride or max(maxlen // 2, 1)
+        last = max(len(doc_ids) - maxlen, 0)
+        starts = list(range(0, last + 1, stride))
+        # The last window is aligned to the end of the document so no tail is lost
+        if starts[-1] != last:
+            starts.append(last)
+        return [doc_ids[start: start + maxlen] for start in starts]
+
+    def _pack_paragraphs(self, paragraph_ids, maxlen):
+        passages, current = [], []
+        for ids in paragraph_ids:
+            pieces = split_doc(ids, maxlen)[0] if len(ids) > maxlen else [ids]
+            for piece in pieces:
+                if current and sum(len(p) for p in current) + len(piece) > maxlen:
+                    passages.append(np.concatenate(current))
+                    current = []
+                current.append(piece)
+        if current:
+            passages.append(np.concatenate(current))
+        return passages
+
+    def select(self, passages, query_ids = None):
+        """
+        Keeps at most max_passages passages of a document, in document order
+        :param passages: the passages of the document
+        :param query_ids: the token ids of the query, needed by the 'bm25' selection
+        :return: the kept passages
+        """
+
+        if self.max_passages is None or len(passages) <= self.max_passages:
+            return passages
+
+        head = min(self.head, self.max_passages)
+        rest = self.max_passages - head
+        if self.selection == 'first' or not rest:
+            return passages[:self.max_passages]
+        if query_ids is None:
+            raise Exception("The bm25 passage selection needs the query")
+
+        scores = self._bm25(passages[head:], query_ids)
+        best = np.sort(np.argsort(-scores, kind='stable')[:rest]) + head
+        return passages[:head] + [passages[i] for i in best]
+
+    # BM25 of the query against every passage, with the document frequencies taken among the passages of the doc
+    def _bm25(self, passages, query_ids):
+        terms = np.unique(query_ids)
+        tfs = np.zeros((len(passages), len(terms)))
+        for i, ids in enumerate(passages):
+            found = ids[np.isin(ids, terms)]
+            tfs[i] = np.bincount(np.searchsorted(terms, found), minlength=len(terms))
+
+        lengths = np.array([len(ids) for ids in passages], dtype=np.float64)
+        df = np.count_nonzero(tfs, axis=0)
+        idf = np.log(1 + (len(passages) - df + 0.5) / (df + 0.5))
+        norm = self.k1 * (1 - self.b + self.b * lengths / max(lengths.mean(), 1.))
+        return (idf * tfs * (self.k1 + 1) / (tfs + norm[:, None])).sum(axis=1)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DocumentPrefetcher():
+    """
+    Loads the upcoming items of a stream in a pool of threads while the caller works on the current one, i.e. reads,
+    parses and tokenizes the next documents while the model encodes the current batch. File reads release the GIL and
+    so does the encoder, so both overlap. At most depth items are loaded ahead of the one being consumed: the threads
+    only get new work as the caller takes results, so a slow consumer stalls them instead of filling the memory.
+    Results are returned in the order of the stream.
+    """
+
+    def __init__(self, load, workers = 4, depth = 64, metrics = None):
+        """
+        :param load: a function loading one item of the stream, it runs in the threads
+        :param workers: the number of loading threads
+        :param depth: the maximum number of items loaded or being loaded ahead of the consumer
+        :param metrics: optional Metrics to report how long the consumer waits for the threads
+        """
+
+        if workers < 1 or depth < 1:
+            raise Exception("The prefetcher needs at least one worker and a depth of one")
+        self.load = load
+        self.workers = workers
+        self.depth = depth
+        self.metrics = metrics
+
+    def iterate(self, items):
+        """
+        Loads a stream of items ahead of the caller
+        :param items: an iterable of items, consumed lazily and only from the calling thread
+        :return: a generator of (item, loaded, error), loaded is None and error the exception if the load failed
+        """
+
+        items = iter(items)
+        pending = deque()
+        executor = ThreadPoolExecutor(self.workers, thread_name_prefix='prefetch')
+        try:
+            for item in itertools.islice(items, self.depth):
+                pending.append((item, executor.submit(self.load, item)))
+
+            while pending:
+                item, future = pending.popleft()
+                # The window is refilled before waiting, so the threads stay busy while the caller is blocked
+                for next_item in itertools.islice(items, 1):
+                    pending.append((next_item, executor.submit(self.load, next_item)))
+
+                try:
+                    if self.metrics is not None and not future.done():
+                        with self.metrics.timer('prefetch_wait'):
+                            loaded = future.result()
+                    else:
+                        loaded = future.result()
+                except Exception as e:
+                    yield item, None, e
+                    continue
+                yield item, loaded, None
+        finally:
+            # Stopping early drops the items not started yet and waits for the ones being loaded
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import math
+from collections import OrderedDict
+
+
+class TokenBudgetScheduler():
+    """
+    Batches the chunks of a stream of documents by length instead of by document. Chunks are put in length buckets
+    that grow geometrically, so the chunks of a bucket differ by at most a growth fraction of their length, and a
+    bucket is encoded before its padded size would exceed the token budget. Every submitted document is tracked until
+    all its chunks are encoded, and finished documents are returned in the order they were submitted. To bound the
+    memory, when more than max_pending documents are waiting the bucket holding the oldest one is encoded early.
+    """
+
+    def __init__(self, encode, token_budget = 16384, growth = 0.05, max_pending = 256, metrics = None):
+        """
+        :param encode: a function encoding a list of formatted inputs in one forward pass, returning one pooled
+        tensor per input, i.e. BertSimilarity._encode_batch
+        :param token_budget: the maximum number of tokens of a batch, padding included
+        :param growth: the relative width of the length buckets, the bound of the padding share of a full bucket
+        :param max_pending: the number of unfinished documents that forces the oldest one through
+        :param metrics: optional Metrics to report the failed batches to
+        """
+
+        self.encode = encode
+        self.token_budget = token_budget
+        self.growth = growth
+        self.max_pending = max_pending
+        self.metrics = metrics
+        self.buckets = {}
+        # seq -> [key, pooled chunks, chunks left, failed]
+        self.docs = OrderedDict()
+        self.seq = 0
+
+    def _bucket(self, length):
+        return int(math.log(max(length, 1)) / math.log(1 + self.growth))
+
+    def submit(self, key, inputs):
+        """
+        Adds the chunks of a document, encoding a bucket whenever the next chunk would take it over the budget
+        :param key: the caller's identifier of the document, returned with its result
+        :param inputs: the formatted inputs of the chunks of the document
+        :return: the list of (key, pooled) of the documents finished so far, in submission order. pooled holds the
+        pooled tensor of every chunk, or is None if the encoding of one of them failed
+        """
+
+        seq = self.seq
+        self.seq += 1
+        self.docs[seq] = [key, [None] * len(inputs), len(inputs), False]
+        for i, item in enumerate(inputs):
+            bucket = self._bucket(len(item[0]))
+            maxlen, entries = self.buckets.get(bucket, (0, []))
+            maxlen = max(maxlen, len(item[0]))
+            if entries and (len(entries) + 1) * maxlen > self.token_budget:
+                self._encode_bucket(bucket)
+                maxlen, entries = len(item[0]), []
+            entries.append((seq, i, item))
+            self.buckets[bucket] = (maxlen, entries)
+
+        finished = self._finished()
+        while len(self.docs) > self.max_pending:
+            oldest = next(iter(self.docs))
+            self._encode_bucket(next(bucket for bucket, (_, entries) in self.buckets.items()
+                                     if any(entry[0] == oldest for entry in entries)))
+            finished += self._finished()
+        return finished
+
+    def flush(self):
+        """
+        Encodes every remaining chunk
+        :return: the list of (key, pooled) of the remaining documents, in submission order
+        """
+
+        while self.buckets:
+            self._encode_bucket(next(iter(self.buckets)))
+        return self._finished()
+
+    # A bucket never holds more than the budget, so it is encoded in a single batch
+    def _encode_bucket(self, bucket):
+        _, entries = self.buckets.pop(bucket)
+        try:
+            pooled = self.encode([item for _, _, item in entries])
+        except Exception as e:
+            if self.metrics is not None:
+                self.metrics.error(e)
+            pooled = [None] * len(entries)
+
+        for (seq, i, _), embeds in zip(entries, pooled):
+            doc = self.docs[seq]
+            doc[1][i] = embeds
+            doc[2] -= 1
+            doc[3] = doc[3] or embeds is None
+
+    def _finished(self):
+        finished = []
+        while self.docs and not self.docs[next(iter(self.docs))][2]:
+            key, pooled, _, failed = self.docs.popitem(last=False)[1]
+            finished.append((key, None if failed else pooled))
+        return finished
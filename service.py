@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Long-lived ranking service: loads the model, the documents and the indexes once and answers ad-hoc queries over
+# HTTP with TREC-formatted rankings. Example:
+#   python service.py --model ./pretrained_models/scibert_scivocab_uncased --docs ./data/round3/ \
+#       --metadata ./data/round3/metadata.csv --embeddings ./data/round3/embeddings/ --port 8080
+#   curl -d '{"query": "coronavirus origin", "k": 10}' localhost:8080/rank
+#   curl -H 'Content-Type: application/xml' --data-binary @topics-rnd3.xml 'localhost:8080/rank?k=100'
+
+import json
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from data import Topic, TopicCollection
+
+
+class RankingService():
+    """
+    Answers ranking requests with an already loaded RankerManager. Requests that arrive while a batch is being ranked
+    wait in a queue, and a single worker takes up to max_batch of them at a time, waiting at most max_wait seconds to
+    fill the batch, so the queries of concurrent requests are encoded together and scored against the documents in
+    the same pass. With an embedding index the documents are scored from it, through the ANN index if one is given,
+    otherwise the manager ranks its valid_docs (or its first-stage candidates) with the model. Requests can ask for
+    fewer documents per topic than max_k, the manager's k by default, but not for more.
+    """
+
+    def __init__(self, manager, index = None, ann = None, shortlist = None, n_probe = None, max_batch = 32,
+                 max_wait = 0.005, max_k = None):
+        self.manager = manager
+        # The manager's k changes with every batch, the default and the cap of the requests are kept apart
+        self.max_k = max_k or manager.k
+        self.index = index
+        self.ann = ann
+        self.shortlist = shortlist
+        self.n_probe = n_probe
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.worker = None
+
+    def start(self):
+        self.worker = threading.Thread(target=self._serve_batches, daemon=True)
+        self.worker.start()
+        return self
+
+    def rank(self, topics, k = None):
+        """
+        Ranks the documents for some topics, blocking until the batch holding them is ranked
+        :param topics: a TopicCollection
+        :param k: the number of documents per topic, max_k if None
+        :return: the TREC run lines of the topics
+        """
+
+        future = Future()
+        self.requests.put((topics, self.check_k(k), future))
+        return future.result()
+
+    # A bad k would fail the whole batch its request is ranked with, so it is rejected before being queued
+    def check_k(self, k):
+        if k is None:
+            return self.max_k
+        if isinstance(k, str) and k.strip().isdigit():
+            k = int(k)
+        if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= self.max_k:
+            raise Exception("k must be an integer between 1 and %s" % self.max_k)
+        return k
+
+    def rank_query(self, query, k = None, qid = '1'):
+        topics = TopicCollection(None)
+        topics.add_topic(Topic(qid, query, '', ''))
+        return self.rank(topics, k)
+
+    def _serve_batches(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            self._rank_batch(batch)
+
+    def _rank_batch(self, batch):
+        # The topics of every request are renamed so requests reusing the same topic numbers do not collide
+        topics = TopicCollection(None)
+        for n, (request_topics, _, _) in enumerate(batch):
+            for qid, topic in request_topics.topics.items():
+                topics.add_topic(Topic('%s:%s' % (n, qid), topic.query, topic.question, topic.narrative))
+
+        try:
+            self.manager.topics = topics
+            self.manager.k = max(k for _, k, _ in batch)
+            with self.manager.metrics.timer('service_batch'):
+                if self.ann is not None:
+                    result = self.manager.pair_doc_query_from_ann(self.index, self.ann, self.shortlist, self.n_probe)
+                elif self.index is not None:
+                    result = self.manager.pair_doc_query_from_index(self.index)
+                else:
+                    result = self.manager.pair_doc_query()
+            ranked = self.manager.get_top_k(result)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        self.manager.metrics.count('service_requests', len(batch))
+        self.manager.metrics.count('service_batches')
+        by_request = [[] for _ in batch]
+        for qid, docid, score, pos in ranked:
+            n, request_qid = qid.split(':', 1)
+            if pos <= batch[int(n)][1]:
+                by_request[int(n)].append((request_qid, docid, score, pos))
+        for (_, _, future), request_ranked in zip(batch, by_request):
+            future.set_result(self.manager.format_result(request_ranked))
+
+
+class RankingRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /rank with a json body {"query": "...", "k": 10} or {"queries": {"qid": "...", ...}, "k": 10}, or with a
+    topics xml body. k can also be given in the query string, it is at most the k of the service. The answer is the
+    TREC run of the topics as text.
+    GET /metrics returns the metrics of the service as json.
+    """
+
+    service = None
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/metrics':
+            self._reply(200, json.dumps(self.service.manager.metrics.to_dict()), 'application/json')
+        else:
+            self._reply(404, 'Not found\n')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/rank':
+            self._reply(404, 'Not found\n')
+            return
+
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+            topics, k = self._parse_request(body)
+            k = self.service.check_k(parse_qs(url.query).get('k', [k])[0])
+        except Exception as e:
+            self._reply(400, 'Bad request: %s\n' % e)
+            return
+
+        try:
+            lines = self.service.rank(topics, k)
+        except Exception as e:
+            self._reply(500, 'Ranking failed: %s\n' % e)
+            return
+        self._reply(200, ''.join(lines))
+
+    def _parse_request(self, body):
+        if body.lstrip().startswith('<'):
+            return TopicCollection.from_xml(body), None
+
+        request = json.loads(body)
+        queries = request['queries'] if 'queries' in request else {'1': request['query']}
+        topics = TopicCollection(None)
+        for qid, query in queries.items():
+            topics.add_topic(Topic(str(qid), query, '', ''))
+        return topics, request.get('k')
+
+    def _reply(self, status, text, content_type = 'text/plain'):
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(service, host = '127.0.0.1', port = 8080):
+    handler = type('Handler', (RankingRequestHandler,), {'service': service})
+    server = ThreadingHTTPServer((host, port), handler)
+    print("Serving rankings on http://%s:%s/rank" % (host, port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve rankings of ad-hoc queries over HTTP')
+    parser.add_argument('--model', required=True, help='pretrained model folder or name')
+    parser.add_argument('--docs', required=True, help='data folder with the documents store')
+    parser.add_argument('--metadata', required=True, help='metadata.csv file')
+    parser.add_argument('--schema', default='round3', choices=['round2', 'round3'])
+    parser.add_argument('--valid-docs', default=None, help='file with the ids of the documents to rank')
+    parser.add_argument('--embeddings', default=None, help='DocumentEmbeddingIndex folder, implies bi-encoder mode')
+    parser.add_argument('--ann', default=None, help='IVFIndex folder built over the embeddings')
+    parser.add_argument('--bm25', default=None, help='BM25Index folder to re-rank its candidates without embeddings')
+    parser.add_argument('--candidates', type=int, default=100)
+    parser.add_argument('--backend', default='fp32', choices=['fp32', 'int8', 'torchscript', 'onnx'])
+    parser.add_argument('--k', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--max-batch', type=int, default=32, help='requests ranked together')
+    parser.add_argument('--max-wait', type=float, default=0.005, help='seconds to wait for a batch to fill')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    if args.ann and not args.embeddings:
+        parser.error('--ann needs --embeddings')
+
+    from data import read_valid_docs
+    from data_loader import TrecCovidDatasetManager
+    from model import BertSimilarity, RankerManager
+
+    cov_dm = TrecCovidDatasetManager(args.docs, args.metadata)
+    cov_dm.load_metadata_from_csv(args.schema)
+    cov_dm.load_docs_store()
+    valid_docs = read_valid_docs(args.valid_docs) if args.valid_docs else cov_dm.get_valid_docs()
+
+    index = ann = first_stage = None
+    if args.embeddings:
+        from embeddings import DocumentEmbeddingIndex
+        index = DocumentEmbeddingIndex(args.embeddings)
+        index.load()
+    if args.ann:
+        from ann import IVFIndex
+        ann = IVFIndex(args.ann)
+        ann.load()
+    if args.bm25:
+        from bm25 import BM25Index
+        first_stage = BM25Index(args.bm25)
+        first_stage.load()
+
+    ranking_model = BertSimilarity(args.model, batch_size=args.batch_size, backend=args.backend,
+                                   mode='bi' if index is not None else 'cross')
+    manager = RankerManager(ranking_model, TopicCollection(None), cov_dm, valid_docs, batch_size=args.batch_size,
+                            k=args.k, first_stage=first_stage, candidates=args.candidates)
+    service = RankingService(manager, index, ann, max_batch=args.max_batch, max_wait=args.max_wait).start()
+    serve(service, args.host, args.port)
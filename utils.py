@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import heapq
 import math
-import torch
 
 def subbatch(toks, maxlen):
+    import torch
     _, DLEN = toks.shape[:2]
     SUBBATCH = math.ceil(DLEN / maxlen)
     S = math.ceil(DLEN / SUBBATCH) if SUBBATCH > 0 else 0 # minimize the size given the number of subbatch
@@ -30,3 +31,63 @@ def split_doc(toks, maxlen):
         for s in range(SUBBATCH):
             stack.append(toks[s*S:(s+1)*S])
         return stack, SUBBATCH
+
+
+# Keeps the k best scored docs of every topic in a bounded min-heap, so memory is O(topics x k)
+class TopKAccumulator():
+    def __init__(self, k):
+        self.k = k
+        self.heaps = {}
+
+    # Ties are broken by position, the doc that came first in valid_docs wins
+    def push(self, qid, docid, score, position):
+        heap = self.heaps.setdefault(qid, [])
+        item = (score, -position, docid)
+        if len(heap) < self.k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    def merge(self, other):
+        for qid, heap in other.heaps.items():
+            for score, neg_position, docid in heap:
+                self.push(qid, docid, score, -neg_position)
+        return self
+
+    # Returns (qid, docid, score, rank) tuples, best first for every topic, topics in the given order
+    def ranked(self, qids = None):
+        result = []
+        for qid in (self.heaps if qids is None else qids):
+            ordered = sorted(self.heaps.get(qid, []), reverse=True)
+            result += [(qid, docid, score, i) for i, (score, _, docid) in enumerate(ordered, start=1)]
+        return result
+
+
+# Scales every row to unit L2 norm, all-zero rows stay zero
+def normalize_rows(embeds, eps = 1e-12):
+    return embeds / embeds.norm(dim=-1, keepdim=True).clamp_min(eps)
+
+# Cosine similarity of every query against every doc as one matrix product: (queries x dim), (docs x dim) -> (queries x docs)
+def cosine_scores(query_embeds, doc_embeds):
+    return normalize_rows(query_embeds) @ normalize_rows(doc_embeds).T
+
+# Cosine similarity of the i-th query with the i-th doc: (n x dim), (n x dim) -> (n,)
+def paired_cosine_scores(query_embeds, doc_embeds):
+    return (normalize_rows(query_embeds) * normalize_rows(doc_embeds)).sum(dim=-1)
+
+# Sums the rows of values that share a segment id, segments without rows are zero
+def segment_sum(values, segment_ids, n_segments):
+    result = values.new_zeros((n_segments,) + tuple(values.shape[1:]))
+    return result.index_add_(0, segment_ids, values)
+
+# Averages the rows of values that share a segment id, segments without rows are zero
+def segment_mean(values, segment_ids, n_segments):
+    import torch
+    counts = torch.bincount(segment_ids, minlength=n_segments).clamp_min(1).to(values.dtype)
+    return segment_sum(values, segment_ids, n_segments) / counts.view((-1,) + (1,) * (values.dim() - 1))
+
+# Maximum of the rows of values that share a segment id, segments without rows are -inf
+def segment_max(values, segment_ids, n_segments):
+    result = values.new_full((n_segments,) + tuple(values.shape[1:]), float('-inf'))
+    index = segment_ids.view((-1,) + (1,) * (values.dim() - 1)).expand_as(values)
+    return result.scatter_reduce_(0, index, values, reduce='amax')